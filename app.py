@@ -1,60 +1,38 @@
 import streamlit as st
 import os
 import pandas as pd
-import sqlite3
 import uuid
 import time
-import graphviz
+import asyncio
+import threading
+import io
 from utils import  custom_css
+from db import migrate_database, DATABASE_PATH
+from llm import get_chat_model
+from pipeline import run_stage, run_concurrently, PipelineCancelled, generate_sql_query, run_query, run_sample_query, stream_answer_in_text_form
+from sql_cache import get_sql_cache_stats
+from schema_context import get_schema_context
+from index_advisor import get_index_report, describe_index_use
+from result_cache import get_result_cache_stats
+from result_store import SessionResultStore, RESULT_PAGE_ROWS
+from metrics import trace_turn, span, get_stage_summary, start_metrics_server
+from batch import iter_batch, read_questions, format_batch_results, BATCH_CONCURRENCY
+from chat_history import save_chat_history, load_chat_history, load_chat_messages
+from datasets import file_fingerprint, lookup_dataset, ingest_upload, touch_dataset
 from streamlit_option_menu import option_menu
-from langchain_anthropic import ChatAnthropic
-from typing import Iterator
-model   =   ChatAnthropic(
-                model="claude-3-5-sonnet-20240620",
-                    temperature=0,
-             max_tokens= 8192, top_p= 0
-            )
-
-
-
-def format_answer_in_text_form(user_question: str, answer: pd.DataFrame, sql_query: str) -> str:
-    if isinstance(answer, pd.DataFrame) and len(answer) <= 104:
-        answer_dict = answer.to_dict()
-        answer_format = f'''Summarize the answer to the question: "{user_question}" using the provided JSON data: "{answer_dict}", and the SQL query used to obtain this data: "{sql_query}".
-
-                            1. Analyze the SQL query to understand:
-                            - The tables and columns being queried
-                            - Any joins, aggregations, or transformations applied
-                            - The meaning and context of each column in the result set
-
-                            2. Based on this analysis, interpret the data in the JSON, understanding what each field represents.
-
-                            3. Summarize the answer for a business executive audience:
-                            - Use bullet points for clarity
-                            - Highlight key numbers using bold formatting (e.g., **1000**)
-                            - Use tables only when necessary for clarity
-                            - Focus on directly answering the question without extra recommendations or reasoning
-                            - Keep the summary concise and to the point
-
-                            4. Formatting guidelines:
-                            - Start directly with the answer, without mentioning the audience or using phrases like "Here is a summary..."
-                            - Use a single blank line between bullet points
-                            - Replace any '$' with "\$" in the final text
-                            - Present the information as a natural, conversational response without referencing the data source
-
-                            Aim for a clear, concise summary that directly addresses the question based on the provided data and query analysis.'''
-        response = model.invoke(answer_format)
-        return str(response.content)  # Ensure we return a string
-    return "No answer could be generated."  # Default return if conditions are not met
+
+# Turns drawn when the chat opens; "Show earlier messages" reveals this many more each time
+CHAT_WINDOW_TURNS = 10
+# Turns kept in session state; older turns stay in the chat history and are read back when asked for
+CHAT_MEMORY_TURNS = 50
+# Result rows read from the result store at a time while writing an export
+EXPORT_PAGE_ROWS = 10000
+
 
 def validate_api_key(api_key):
     try:
-        model = ChatAnthropic(
-            api_key=api_key,
-            model="claude-3-5-sonnet-20240620",
-            temperature=0, top_p=0
-        )
-        model.invoke("Hello")
+        # The validated client is the one later questions reuse
+        get_chat_model(api_key).invoke("Hello")
         return True
     except Exception as e:
         return False
@@ -62,82 +40,67 @@ def validate_api_key(api_key):
 if 'current_chat_id' not in st.session_state:
     st.session_state.current_chat_id = str(uuid.uuid4())
 
-# Function to migrate the database
-def migrate_database():
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    # Check if the chat_history table exists
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chat_history'")
-    table_exists = cursor.fetchone()
-    
-    if table_exists:
-        # Check if chat_id column exists
-        cursor.execute("PRAGMA table_info(chat_history)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'chat_id' not in columns:
-            # Add chat_id column
-            cursor.execute("ALTER TABLE chat_history ADD COLUMN chat_id TEXT")
-            
-            # Update existing rows with a default chat_id
-            default_chat_id = str(uuid.uuid4())
-            cursor.execute("UPDATE chat_history SET chat_id = ? WHERE chat_id IS NULL", (default_chat_id,))
-            
-            conn.commit()
-            print("Database migrated: added chat_id column")
-    else:
-        # Create the chat_history table with the correct schema
-        cursor.execute("""
-        CREATE TABLE chat_history
-        (id TEXT PRIMARY KEY, chat_id TEXT, user_input TEXT, bot_response TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
-        """)
-        print("Database migrated: created chat_history table")
-    
-    conn.close()
-
-# Call the migration function at the start of the app
-migrate_database()
-
 # Function to handle file upload
 def upload_file():
-    file = st.file_uploader("Upload CSV or Excel file", type=["csv", "xlsx"])
-    if file is not None:
-        if file.name.endswith('csv'):
-            df = pd.read_csv(file)
-        elif file.name.endswith('xlsx'):
-            df = pd.read_excel(file)
-        st.session_state['uploaded_df'] = df
-        return df
-    return st.session_state.get('uploaded_df', None)
-
-# Function to save DataFrame to database using raw SQL commands
-def save_to_db(df):
-    conn = sqlite3.connect('mydatabase.db')
-    cursor = conn.cursor()
-    
-    # Drop table if it exists
-    cursor.execute("DROP TABLE IF EXISTS my_table")
-    
-    # Create table with columns based on DataFrame
-    columns = ', '.join([f'"{col}" TEXT' for col in df.columns])
-    cursor.execute(f"CREATE TABLE my_table ({columns})")
-    
-    # Insert data into table
-    placeholders = ', '.join(['?'] * len(df.columns))
-    insert_query = f"INSERT INTO my_table VALUES ({placeholders})"
-    
-    # Convert all data to strings before inserting
-    for row in df.itertuples(index=False):
-        # Convert each element to string
-        string_row = tuple(str(elem) if elem is not None else '' for elem in row)
-        cursor.execute(insert_query, string_row)
-    
-    conn.commit()
-    conn.close()
+    return st.file_uploader("Upload CSV or Excel file", type=["csv", "xlsx"])
+
+# Function to fingerprint an upload once per file and reuse the hash across reruns
+def get_upload_fingerprint(file):
+    fingerprints = st.session_state.setdefault('upload_fingerprints', {})
+    key = getattr(file, 'file_id', None) or (file.name, file.size)
+    if key not in fingerprints:
+        fingerprints[key] = file_fingerprint(file)
+    return fingerprints[key]
+
+# Function to stream an uploaded file into its own dataset tables without materializing it.
+# Returns None when the same content is already loaded, so reruns do not re-ingest.
+def save_upload_to_db(file):
+    fingerprint = get_upload_fingerprint(file)
+    dataset = st.session_state.get('dataset')
+    if dataset is not None and dataset.get('fingerprint') == fingerprint:
+        return None
+
+    existing = lookup_dataset(fingerprint, db_path=DATABASE_PATH)
+    if existing is not None:
+        st.session_state['dataset'] = existing
+        st.session_state['schema'] = get_schema(get_dataset_tables())
+        return None
+
+    tables = ingest_upload(file, fingerprint, db_path=DATABASE_PATH)
+    return register_dataset(tables, fingerprint, file.name)
+
+# Function to keep only a lightweight handle to the ingested tables in session state
+def register_dataset(tables, fingerprint, file_name):
+    st.session_state['dataset'] = {
+        "fingerprint": fingerprint,
+        "file_name": file_name,
+        "tables": [{"table": t["table"], "sheet": t["sheet"], "rows": t["rows"], "preview": t["preview"]} for t in tables],
+    }
+    stats = {
+        "rows": sum(t["rows"] for t in tables),
+        "seconds": sum(t["seconds"] for t in tables),
+    }
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else float(stats["rows"])
+    st.session_state['ingest_stats'] = stats
 
     # Update the schema in session state
-    st.session_state['schema'] = get_schema()
+    st.session_state['schema'] = get_schema(get_dataset_tables())
+    return stats
+
+# Function to list the tables belonging to the current session's dataset
+def get_dataset_tables():
+    dataset = st.session_state.get('dataset')
+    if dataset is None:
+        return []
+    return [t["table"] for t in dataset["tables"]]
+
+# Function to keep the session's tables alive in the shared store and drop the handle if they were evicted
+def check_dataset():
+    tables = get_dataset_tables()
+    if tables and not touch_dataset(tables, db_path=DATABASE_PATH):
+        st.session_state['dataset'] = None
+        st.session_state.pop('schema', None)
+        st.warning("Your dataset was removed after a period of inactivity. Please upload it again.")
 
 def create_table_node(dot, table_name, schema, is_fact_table=False):
     table_label = f"<<TABLE BORDER='0' CELLBORDER='1' CELLSPACING='0'>"
@@ -150,13 +113,9 @@ def create_table_node(dot, table_name, schema, is_fact_table=False):
     
     dot.node(table_name, label=table_label, shape='plaintext')
 
-def get_schema():
-    conn = sqlite3.connect('mydatabase.db')
-    table_name = "my_table"
-    query = f"PRAGMA table_info({table_name})"
-    schema_df = pd.read_sql(query, con=conn)
-    conn.close()
-    return schema_df
+# Function to get the schema of the given tables; this also precomputes their prompt context
+def get_schema(tables):
+    return get_schema_context(tables)["schema_df"]
 
 def show_schema():
     if 'schema' not in st.session_state or st.session_state['schema'].empty:
@@ -165,143 +124,33 @@ def show_schema():
     
     schema_df = st.session_state['schema']
     
-    # Convert schema DataFrame to a list of tuples for processing
-    table_schema = [(row['name'], row['type']) for _, row in schema_df.iterrows()]
-    
+    # graphviz is only needed once a schema is shown, so it is imported here rather than at startup
+    import graphviz
     dot = graphviz.Digraph(engine='dot')
     dot.attr(rankdir='LR', nodesep='0.5', ranksep='2', splines='curved', concentrate='true')
     
-    # Create the table node (assuming it's the fact table)
-    with dot.subgraph(name='cluster_fact') as c:
-        c.attr(label='', style='invis')
-        create_table_node(c, "my_table", table_schema, is_fact_table=True)
-    
-    # Assuming relationships are defined by `_ID` or `_DIM_ID` suffix in column names
-    keys = [col[0] for col in table_schema if col[0].lower().endswith(('_id', '_dim_id'))]
-    
-    for key in keys:
-        dot.edge(f'"my_table":"{key}"', f'"my_table":"{key}"', 
-                 label=key,
-                 fontsize='10', fontcolor='#333333',
-                 dir='none',
-                 arrowhead='none', arrowtail='none',
-                 penwidth='2', color='#5D5D5D',
-                 minlen='2', style='bold')
-
-    st.graphviz_chart(dot)
-# Function to execute SQL queries
-def execute_query(query):
-    conn = sqlite3.connect('mydatabase.db')
-    try:
-        result_df = pd.read_sql(query, con=conn)
-        return result_df
-    except sqlite3.Error as e:
-        st.error(f"Error executing query: {e}")
-        return None
-    finally:
-        conn.close()
-
-# Function to generate SQL query using ChatBedrock
-def generate_sql_query(user_question):
-    model   =   ChatAnthropic(
-                model="claude-3-5-sonnet-20240620",
-                    temperature=0,
-             max_tokens= 8192, top_p= 0
-            )
-    
-    # Get the schema information
-    conn = sqlite3.connect('mydatabase.db')
-    query = "PRAGMA table_info(my_table)"
-    schema_df = pd.read_sql(query, con=conn)
-    conn.close()
-    
-    schema_info = schema_df.to_string()
-    
-    prompt = f"""Given the following schema for the 'my_table' table:
-
-{schema_info}
-
-Generate a SQL query to answer the following question:
-
-{user_question}
-
-Return only the SQL query without any explanations."""
-
-    response = model.invoke(prompt)
-    return response.content
-
-# Function to save chat history to database
-def save_chat_history(chat_id, user_input, bot_response):
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    # Create table if it doesn't exist
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS chat_history
-    (id TEXT PRIMARY KEY, chat_id TEXT, user_input TEXT, bot_response TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
-    """)
-    
-    # Insert new chat entry
-    entry_id = str(uuid.uuid4())
-    
-    # Convert all inputs to strings
-    chat_id = str(chat_id)
-    user_input = str(user_input)
-    bot_response = str(bot_response)
-    
-    try:
-        cursor.execute("INSERT INTO chat_history (id, chat_id, user_input, bot_response) VALUES (?, ?, ?, ?)",
-                       (entry_id, chat_id, user_input, bot_response))
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
-    finally:
-        conn.close()
-
-# Function to load chat history from database
-def load_chat_history(chat_id):
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    # Create table if it doesn't exist (this ensures the chat_id column exists)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS chat_history
-    (id TEXT PRIMARY KEY, chat_id TEXT, user_input TEXT, bot_response TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
-    """)
-    
-    cursor.execute("SELECT user_input, bot_response FROM chat_history WHERE chat_id = ? ORDER BY timestamp", (chat_id,))
-    history = cursor.fetchall()
-    
-    conn.close()
-    return history
-
-# Function to get all chat IDs
-def get_all_chat_ids():
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    # Create table if it doesn't exist
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS chat_history
-    (id TEXT PRIMARY KEY, chat_id TEXT, user_input TEXT, bot_response TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
-    """)
-    
-    cursor.execute("SELECT DISTINCT chat_id FROM chat_history ORDER BY timestamp DESC")
-    chat_ids = cursor.fetchall()
-    
-    conn.close()
-    return [chat_id[0] for chat_id in chat_ids]
+    for index, (table_name, table_df) in enumerate(schema_df.groupby('table', sort=False)):
+        # Convert schema DataFrame to a list of tuples for processing
+        table_schema = [(row['name'], row['type']) for _, row in table_df.iterrows()]
 
-# Function to delete a chat
-def delete_chat(chat_id):
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
-    
-    conn.commit()
-    conn.close()
+        # Create the table node (assuming the first table is the fact table)
+        with dot.subgraph(name=f'cluster_{index}') as c:
+            c.attr(label='', style='invis')
+            create_table_node(c, table_name, table_schema, is_fact_table=index == 0)
+        
+        # Assuming relationships are defined by `_ID` or `_DIM_ID` suffix in column names
+        keys = [col[0] for col in table_schema if col[0].lower().endswith(('_id', '_dim_id'))]
+        
+        for key in keys:
+            dot.edge(f'"{table_name}":"{key}"', f'"{table_name}":"{key}"', 
+                     label=key,
+                     fontsize='10', fontcolor='#333333',
+                     dir='none',
+                     arrowhead='none', arrowtail='none',
+                     penwidth='2', color='#5D5D5D',
+                     minlen='2', style='bold')
 
+    st.graphviz_chart(dot)
 def main():
     st.set_page_config(page_title="DataDialogue", page_icon="🤖", layout="wide")
     st.markdown(
@@ -316,6 +165,11 @@ def main():
 
     custom_css()
 
+    # Set up the databases; this runs once per process, not on every rerun
+    migrate_database()
+    if os.environ.get("DATADIALOGUE_METRICS_PORT"):
+        start_metrics_server(int(os.environ["DATADIALOGUE_METRICS_PORT"]))
+
     # Initialize session state for API key validation
     if 'api_key_validated' not in st.session_state:
         st.session_state.api_key_validated = False
@@ -353,8 +207,9 @@ def show_auth_ui():
 
 def show_main_app():
     # Initialize session state for uploaded data and current chat ID
-    if 'uploaded_df' not in st.session_state:
-        st.session_state['uploaded_df'] = None
+    if 'dataset' not in st.session_state:
+        st.session_state['dataset'] = None
+    check_dataset()
     if 'current_chat_id' not in st.session_state:
         st.session_state.current_chat_id = str(uuid.uuid4())
 
@@ -401,14 +256,23 @@ def show_data_management():
             <h3 style='color: #1e3d7d;'>Upload Data</h3>
         """, unsafe_allow_html=True)
         
-        df = upload_file()
-        if df is not None:
-            save_to_db(df)
+        file = upload_file()
+        if file is not None:
+            stats = save_upload_to_db(file)
             st.success("✅ Data successfully uploaded and saved to database!")
+            if stats is not None:
+                st.caption(f"Ingested {stats['rows']:,} rows in {stats['seconds']:.2f}s ({stats['rows_per_second']:,.0f} rows/s)")
+            else:
+                st.caption("File unchanged, reusing the existing table.")
             st.session_state['data_uploaded'] = True
 
+        dataset = st.session_state.get('dataset')
+        if dataset is not None:
             st.markdown("<h3 style='color: #1e3d7d;'>Data Preview</h3>", unsafe_allow_html=True)
-            st.dataframe(df.head(), use_container_width=True)
+            for table in dataset["tables"]:
+                if table["sheet"] is not None:
+                    st.caption(f"Sheet '{table['sheet']}' → table {table['table']}")
+                st.dataframe(table["preview"], use_container_width=True)
         
         st.markdown("</div>", unsafe_allow_html=True)
 
@@ -420,11 +284,48 @@ def show_data_management():
         
         if 'schema' in st.session_state and not st.session_state['schema'].empty:
             show_schema()
+            show_profile()
+            show_indexes()
         else:
             st.info("📤 Please upload a file to view the schema.")
         
         st.markdown("</div>", unsafe_allow_html=True)
 
+# Function to show the column profile computed at ingest time
+def show_profile():
+    profile_df = get_schema_context(get_dataset_tables())["profile_df"]
+    if profile_df.empty:
+        return
+    summary = pd.DataFrame({
+        "table": profile_df["table_name"],
+        "column": profile_df["column_name"],
+        "type": profile_df["col_type"],
+        "null %": (profile_df["null_ratio"] * 100).round(1),
+        "distinct": profile_df["distinct_estimate"],
+        "min": profile_df["min_value"].astype(str),
+        "max": profile_df["max_value"].astype(str),
+        "top value": profile_df["top_values"].map(lambda top: str(top[0][0]) if top else ""),
+    })
+    with st.expander("Column Profile"):
+        st.dataframe(summary, use_container_width=True, hide_index=True)
+
+# Function to show the indexes built at upload and from the query workload, with their measured impact
+def show_indexes():
+    report = get_index_report(get_dataset_tables())
+    if report.empty:
+        return
+    summary = pd.DataFrame({
+        "table": report["table_name"],
+        "column": report["column_name"],
+        "origin": report["reason"].map({"key": "key column", "workload": "query history"}),
+        "status": report["status"],
+        "before ms": (report["before_seconds"] * 1000).round(1),
+        "after ms": (report["after_seconds"] * 1000).round(1),
+        "speedup": report["speedup"].round(1),
+    })
+    with st.expander("Indexes"):
+        st.dataframe(summary, use_container_width=True, hide_index=True)
+
 def show_chat_interface():
     st.markdown("""
     <div style="background-color: #ffffff; padding: 20px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); margin-bottom: 20px;">
@@ -440,17 +341,10 @@ def show_chat_interface():
         # Initialize chat history if not present
         if "messages" not in st.session_state:
             st.session_state.messages = []
+        trim_messages()
         with st.container(border=True,height=600):
         #with st.container(border=True,height=600): Display chat messages
-            for message in st.session_state.messages:
-                if message["role"] == "user":
-                    with st.chat_message(message["role"]):
-                        st.markdown(message["content"])
-                elif message["role"] == "assistant":
-                    with st.chat_message(message["role"]):
-                        st.markdown(message["content"])
-                if message["role"] == "sql_assistant" and "user_df" in message["content"]:
-                    st.dataframe(message["content"]["user_df"])
+            show_messages()
 
             # Chat input
             if user_input:
@@ -467,58 +361,341 @@ def show_chat_interface():
         # Clear chat button
         if st.button("Clear Chat", use_container_width=True):
             st.session_state.messages = []
+            get_result_store().clear()
+            # Start a new chat so earlier turns of the cleared one are not loaded back
+            st.session_state.current_chat_id = str(uuid.uuid4())
+            for key in ('chat_window_turns', 'earlier_turns', 'history_trimmed'):
+                st.session_state.pop(key, None)
+        st.toggle("Progressive answers", key="progressive_mode",
+                  help="On very large tables, show an approximate answer from a sample while the exact query runs")
+        cache_stats = get_sql_cache_stats()
+        st.caption(f"SQL cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+        result_stats = get_result_cache_stats()
+        st.caption(f"Result cache: {result_stats['hits']} hits / {result_stats['misses']} misses")
+        show_batch_mode()
+        show_performance()
         if upload_file is not None:           
             show_schema()
         else:
             st.info("📤 Please upload a file to view the schema.")
         
 
+# Function to answer an uploaded list of questions concurrently and offer the consolidated results
+def show_batch_mode():
+    with st.expander("Batch Questions"):
+        questions_file = st.file_uploader("Upload questions (one per line, or CSV with a 'question' column)",
+                                          type=["txt", "csv"], key="batch_questions")
+        concurrency = st.number_input("Parallel questions", min_value=1, max_value=32, value=BATCH_CONCURRENCY)
+        summarize = st.checkbox("Summarize each answer", value=True)
+        tables = get_dataset_tables()
+        if questions_file is None or not tables:
+            return
+        questions = read_questions(questions_file, questions_file.name)
+        if st.button(f"Run {len(questions)} questions", use_container_width=True):
+            progress = st.progress(0.0, text="Answering questions...")
+            records = [None] * len(questions)
+            for done, (index, record) in enumerate(iter_batch(questions, tables, int(concurrency), summarize), start=1):
+                records[index] = record
+                progress.progress(done / len(questions), text=f"Answered {done}/{len(questions)}")
+            st.session_state['batch_results'] = records
+        records = st.session_state.get('batch_results')
+        if records:
+            failed = sum(record["status"] != "ok" for record in records)
+            st.caption(f"{len(records) - failed}/{len(records)} answered, "
+                       f"{sum(record['timings']['total'] for record in records):.1f}s of question time")
+            st.download_button("Download results (CSV)", format_batch_results(records, "csv"),
+                               file_name="batch_results.csv", mime="text/csv", use_container_width=True)
+            st.download_button("Download results with rows (JSONL)", format_batch_results(records, "jsonl"),
+                               file_name="batch_results.jsonl", mime="application/json", use_container_width=True)
+
+# Function to get the session's result store, which keeps result frames out of session state
+def get_result_store():
+    if 'result_store' not in st.session_state:
+        st.session_state['result_store'] = SessionResultStore()
+    return st.session_state['result_store']
+
+# Function to show a stored result one page at a time, reading only the rows on screen
+def show_result(handle):
+    pages = max(-(-handle["rows"] // RESULT_PAGE_ROWS), 1)
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1,
+                               key=f"result_page_{handle['result_id']}")
+    page_df = get_result_store().get_page(handle, page - 1)
+    if page_df is None:
+        st.caption("This result was removed to save space; ask the question again to see it.")
+        return
+    st.dataframe(page_df, use_container_width=True)
+    if pages > 1:
+        first_row = (page - 1) * RESULT_PAGE_ROWS + 1
+        st.caption(f"Rows {first_row:,}–{first_row + len(page_df) - 1:,} of {handle['rows']:,}")
+
+# Function to show p50/p95 latency, token use and cache hit rate per pipeline stage
+def show_performance():
+    with st.expander("Performance"):
+        summary = get_stage_summary()
+        if summary.empty:
+            st.caption("No questions answered yet.")
+            return
+        st.dataframe(summary.round({"p50_ms": 0, "p95_ms": 0, "avg_input_tokens": 0, "avg_output_tokens": 0, "cache_hit_rate": 2}),
+                     use_container_width=True, hide_index=True)
+        st.caption("Last 24 hours, all sessions")
+
+# Function to get the index of the first message of each turn; a turn starts with the user's question
+def turn_starts(messages):
+    return [index for index, message in enumerate(messages) if message["role"] == "user"]
+
+# Function to drop the oldest turns from session state beyond CHAT_MEMORY_TURNS; they remain in the chat history
+def trim_messages():
+    starts = turn_starts(st.session_state.messages)
+    if len(starts) <= CHAT_MEMORY_TURNS:
+        return
+    del st.session_state.messages[:starts[-CHAT_MEMORY_TURNS]]
+    st.session_state['history_trimmed'] = True
+    # Pages read earlier end where the old window began; read them again when asked
+    st.session_state.pop('earlier_turns', None)
+
+# Function to count the turns in session state that have been written to the chat history
+def count_saved_turns(messages):
+    return sum(bool(message.get("saved")) for message in messages)
+
+# Function to read the next page of older turns from the chat history, skipping those still in session state
+def load_earlier_turns():
+    chat_id = st.session_state.current_chat_id
+    earlier = st.session_state.get('earlier_turns')
+    if earlier is None:
+        saved = count_saved_turns(st.session_state.messages)
+        turns, cursor = load_chat_messages(chat_id, limit=saved + CHAT_WINDOW_TURNS)
+        earlier = {"turns": turns[:max(len(turns) - saved, 0)], "cursor": cursor}
+    else:
+        turns, cursor = load_chat_messages(chat_id, limit=CHAT_WINDOW_TURNS, before=earlier["cursor"])
+        earlier = {"turns": turns + earlier["turns"], "cursor": cursor}
+    st.session_state['earlier_turns'] = earlier
+
+# Function to reveal more of the conversation: hidden turns in session state first, then older pages from the chat history
+def show_earlier_messages():
+    window = st.session_state.get('chat_window_turns', CHAT_WINDOW_TURNS)
+    if len(turn_starts(st.session_state.messages)) > window:
+        st.session_state['chat_window_turns'] = window + CHAT_WINDOW_TURNS
+    else:
+        load_earlier_turns()
+
+# Function to draw only the most recent turns, so reruns do not get slower as the conversation grows
+def show_messages():
+    messages = st.session_state.messages
+    starts = turn_starts(messages)
+    window = st.session_state.get('chat_window_turns', CHAT_WINDOW_TURNS)
+    earlier = st.session_state.get('earlier_turns')
+    more_in_history = st.session_state.get('history_trimmed') and (earlier is None or earlier["cursor"] is not None)
+    if len(starts) > window or more_in_history:
+        st.button("Show earlier messages", on_click=show_earlier_messages, use_container_width=True)
+
+    if earlier is not None and len(starts) <= window:
+        # Turns read back from the chat history carry the question and summary; their result tables are not kept
+        for user_input, bot_response, _ in earlier["turns"]:
+            with st.chat_message("user"):
+                st.markdown(user_input)
+            with st.chat_message("assistant"):
+                st.markdown(bot_response)
+
+    first = starts[-window] if len(starts) > window else 0
+    for message in messages[first:]:
+        if message["role"] == "user":
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
+        elif message["role"] == "assistant":
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
+        if message["role"] == "sql_assistant" and "result" in message["content"]:
+            show_result(message["content"]["result"])
+
+# Function to write a stored result as CSV, reading it from the result store a page at a time
+def iter_result_csv(handle, store):
+    yield f"result ({handle['rows']:,} rows):\n"
+    for page in range(-(-handle["rows"] // EXPORT_PAGE_ROWS)):
+        page_df = store.get_page(handle, page, EXPORT_PAGE_ROWS)
+        if page_df is None:
+            yield "(this result was removed to save space)\n"
+            break
+        yield page_df.to_csv(index=False, header=page == 0)
+    yield "\n"
+
+# Function to produce the transcript piece by piece: turns no longer in session state come from the
+# chat history, then the session's messages with their results as CSV tables
+def iter_chat_transcript(chat_id, messages, store):
+    history = load_chat_history(chat_id)
+    for user_input, bot_response in history[:max(len(history) - count_saved_turns(messages), 0)]:
+        yield f"user: {user_input}\n\nassistant: {bot_response}\n\n"
+    for message in messages:
+        if message["role"] == "sql_assistant":
+            yield from iter_result_csv(message["content"]["result"], store)
+        else:
+            yield f"{message['role']}: {message['content']}\n\n"
+
+# Function to write the transcript chunk by chunk into a buffer the download button can serve;
+# called by the button only when clicked
+def export_chat(chat_id, messages, store):
+    file = io.BytesIO()
+    for chunk in iter_chat_transcript(chat_id, messages, store):
+        file.write(chunk.encode("utf-8"))
+    file.seek(0)
+    return file
+
 def download_chat():
-    chat_content = "\n".join([f"{msg['role']}: {msg['content']}" for msg in st.session_state.messages])
+    # The export runs on another thread, so take what it needs from session state now
+    chat_id = st.session_state.current_chat_id
+    messages = list(st.session_state.messages)
+    store = get_result_store()
     st.download_button(
         label="Download Chat",
-        data=chat_content,
+        data=lambda: export_chat(chat_id, messages, store),
         file_name="chat_history.txt",
         mime="text/plain",
         use_container_width=True
     )
 
-# Update process_user_input function
-def process_user_input(user_input):
-    with st.spinner("Generating SQL..."):
-        sql_query = generate_sql_query(user_input)
+# Function to answer a question as an asyncio pipeline: each stage runs off the script thread,
+# the result table is drawn as soon as the query finishes while the summary is still streaming,
+# and persistence and metrics run side by side at the end
+async def answer_question(user_input, tables, cancel_event):
+    timings = {}
+    started = time.perf_counter()
 
+    with st.spinner("Generating SQL..."):
+        sql_preview = st.empty()
+        sql_query = await run_stage(lambda report: generate_sql_query(user_input, tables, on_token=report), cancel_event,
+                                    on_update=lambda text: sql_preview.code(text, language="sql"))
+        sql_preview.empty()
+    timings["sql"] = time.perf_counter() - started
+
+    stage_started = time.perf_counter()
+    exact = asyncio.ensure_future(run_stage(lambda report: run_query(sql_query, tables, cancel_event), cancel_event))
+    if st.session_state.get("progressive_mode"):
+        approximate_box = st.empty()
+        await show_approximate_answer(user_input, sql_query, tables, exact, approximate_box)
+        # The exact result takes the approximate answer's place
+        approximate_box.empty()
     try:
-        result = execute_query(sql_query)
+        result = await exact
+    except PipelineCancelled:
+        raise
     except Exception as e:
         result = None
         st.error(f"Error executing query: {e}")
-    
+    timings["query"] = time.perf_counter() - stage_started
+
+    if result is not None:
+        for warning in result.attrs.get("warnings", []):
+            st.warning(warning)
+        if result.attrs.get("truncated"):
+            st.warning(f"Showing partial results: the query was {result.attrs['truncation_reason']}.")
+        index_notes = describe_index_use(result.attrs.get("indexes"))
+        if index_notes:
+            st.caption(" ".join(index_notes) + f" This query ran in {result.attrs['seconds'] * 1000:,.0f} ms.")
+
+    # The summary keeps its place above the table, but the table is drawn before the summary streams
     with st.chat_message("assistant"):
-        with st.spinner("Generating response..."):
-            bot_response = format_answer_in_text_form(user_input, result, sql_query)
-            st.write(bot_response)
-        st.session_state.messages.append({"role": "assistant", "content": bot_response})
-    
+        summary_box = st.empty()
+    handle = None
     if result is not None and not result.empty:
+        # Only a handle goes into the chat history; the frame itself lives in the session's result store
+        store = get_result_store()
+        handle = await run_stage(lambda report: store.put(result), cancel_event)
+        with st.chat_message("assistant"):
+            show_result(handle)
+    elif result is None:
+        with st.chat_message("assistant"):
+            st.error("The query encountered an error.")
+    else:
+        with st.chat_message("assistant"):
+            st.warning("The query returned no results.")
+
+    stage_started = time.perf_counter()
+    summary = []
+
+    def show_summary(piece):
+        summary.append(piece)
+        summary_box.markdown("".join(summary) + "▌")
+
+    def summarize(report):
+        for piece in stream_answer_in_text_form(user_input, result, sql_query):
+            report(piece)
+
+    await run_stage(summarize, cancel_event, on_update=show_summary)
+    bot_response = "".join(summary)
+    summary_box.markdown(bot_response)
+    timings["summary"] = time.perf_counter() - stage_started
+
+    # Marks the turn as written to the chat history, which is done below
+    st.session_state.messages.append({"role": "assistant", "content": bot_response, "saved": True})
+    if handle is not None:
         st.session_state.messages.append({
             "role": "sql_assistant",
             "content": {
-                "user_df": result
+                "result": handle
             }
         })
-        with st.chat_message("assistant"):
-            st.dataframe(result, use_container_width=True)
     elif result is None:
         st.session_state.messages.append({"role": "assistant", "content": "The query encountered an error."})
-        with st.chat_message("assistant"):
-            st.error("The query encountered an error.")
     else:
         st.session_state.messages.append({"role": "assistant", "content": "The query returned no results."})
+
+    # Persist the turn while the stage timings are drawn
+    chat_id = st.session_state.current_chat_id
+    persist = asyncio.ensure_future(run_concurrently(lambda: save_chat_history(chat_id, user_input, bot_response)))
+    timings["total"] = time.perf_counter() - started
+    st.session_state["pipeline_timings"] = timings
+    st.caption(" · ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items()))
+    await persist
+
+# Function to show a quick answer from the sample of a large table while the exact query runs.
+# It is best effort: it gives way once the exact result is in, and any failure just skips it.
+async def show_approximate_answer(user_input, sql_query, tables, exact, approximate_box):
+    approximate_cancel = threading.Event()
+    # The exact query ends early too when the question is cancelled, so this also stops the approximate stages then
+    exact.add_done_callback(lambda _: approximate_cancel.set())
+    try:
+        approximate = await run_stage(lambda report: run_sample_query(sql_query, tables, approximate_cancel), approximate_cancel)
+    except Exception:
+        return
+    if approximate is None or exact.done():
+        return
+    summary = []
+    with approximate_box.container():
+        st.info(f"Approximate answer from a {approximate.attrs['sample_fraction']:.1%} sample of the data. "
+                "Counts and totals are estimates; the exact result will replace this when the full query finishes.")
         with st.chat_message("assistant"):
-            st.warning("The query returned no results.")
+            summary_box = st.empty()
+            st.dataframe(approximate.head(RESULT_PAGE_ROWS), use_container_width=True)
+
+    def show_summary(piece):
+        summary.append(piece)
+        summary_box.markdown("_Approximate_\n\n" + "".join(summary) + "▌")
 
-    save_chat_history(st.session_state.current_chat_id, user_input, bot_response)
+    def summarize(report):
+        for piece in stream_answer_in_text_form(user_input, approximate, sql_query):
+            report(piece)
+
+    try:
+        await run_stage(summarize, approximate_cancel, on_update=show_summary)
+    except Exception:
+        return
+    summary_box.markdown("_Approximate_\n\n" + "".join(summary))
+    # Keep the approximate answer on screen until the exact result arrives
+    await asyncio.wait({exact})
+
+def process_user_input(user_input):
+    # A new question cancels whatever is still running for the previous one
+    previous = st.session_state.get("pipeline_cancel")
+    if previous is not None:
+        previous.set()
+    cancel_event = threading.Event()
+    st.session_state["pipeline_cancel"] = cancel_event
+    try:
+        with trace_turn(), span("turn"):
+            asyncio.run(answer_question(user_input, get_dataset_tables(), cancel_event))
+    except PipelineCancelled:
+        st.info("Cancelled.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+import os
+import io
+import csv
+import json
+import time
+import random
+import sqlite3
+import argparse
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from db import migrate_database, DATABASE_PATH
+from datasets import file_fingerprint, lookup_dataset, ingest_upload, get_dataset_tables
+from schema_context import get_schema_context
+from pipeline import generate_sql_query, run_query, format_answer_in_text_form
+from metrics import trace_turn, span
+
+# Questions answered at once; LLM calls are further bounded by DATADIALOGUE_LLM_CONCURRENCY
+BATCH_CONCURRENCY = int(os.environ.get("DATADIALOGUE_BATCH_CONCURRENCY", "4"))
+# Retries of a rate-limited or overloaded LLM call, with exponential backoff unless the API says how long to wait
+BATCH_MAX_RETRIES = 5
+RETRY_BASE_SECONDS = 2.0
+RETRY_MAX_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = {429, 503, 529}
+# Result rows kept per question in the consolidated output
+OUTPUT_MAX_ROWS = 100
+
+
+# Function to get how long to wait before retrying a failed LLM call, or None if it should not be retried
+def retry_delay(error, attempt):
+    if getattr(error, "status_code", None) not in RETRYABLE_STATUS_CODES:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return min(float(headers.get("retry-after")), RETRY_MAX_SECONDS)
+    except (TypeError, ValueError):
+        return min(RETRY_BASE_SECONDS * 2 ** attempt * (1 + random.random()), RETRY_MAX_SECONDS)
+
+
+# Function to call an LLM stage, retrying when the API is rate limiting or overloaded.
+# Returns the stage's result and the number of attempts it took.
+def call_with_retries(func, *args, max_retries=BATCH_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args), attempt + 1
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt == max_retries:
+                raise
+            time.sleep(delay)
+
+
+# Function to answer one batch question; failures are recorded rather than raised
+def answer_batch_question(question, tables, summarize=True):
+    record = {"question": question, "status": "ok", "sql": None, "row_count": None, "answer": None,
+              "error": None, "attempts": 0, "timings": {}, "result": None}
+    started = time.perf_counter()
+    try:
+        record["sql"], attempts = call_with_retries(generate_sql_query, question, tables)
+        record["attempts"] += attempts
+        record["timings"]["sql"] = time.perf_counter() - started
+
+        stage_started = time.perf_counter()
+        try:
+            result = run_query(record["sql"], tables)
+        except (sqlite3.Error, pd.errors.DatabaseError) as e:
+            record["status"] = "query_error"
+            record["error"] = f"Error executing query: {e}"
+            return record
+        finally:
+            record["timings"]["query"] = time.perf_counter() - stage_started
+        record["row_count"] = len(result)
+        record["result"] = json.loads(result.head(OUTPUT_MAX_ROWS).to_json(orient="split", index=False, date_format="iso"))
+
+        if summarize:
+            stage_started = time.perf_counter()
+            record["answer"], attempts = call_with_retries(format_answer_in_text_form, question, result, record["sql"])
+            record["attempts"] += attempts
+            record["timings"]["summary"] = time.perf_counter() - stage_started
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"An error occurred: {e}"
+    finally:
+        record["timings"]["total"] = time.perf_counter() - started
+    return record
+
+
+def traced_batch_question(question, tables, summarize=True):
+    with trace_turn(), span("turn"):
+        return answer_batch_question(question, tables, summarize)
+
+
+# Function to answer a list of questions concurrently. Yields (index, record) as each question
+# finishes, so callers can report progress from their own thread.
+def iter_batch(questions, tables, concurrency=BATCH_CONCURRENCY, summarize=True):
+    # Build the schema context once up front; every question then reuses the cached copy
+    get_schema_context(tables)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+        futures = {executor.submit(traced_batch_question, question, tables, summarize): index
+                   for index, question in enumerate(questions)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# Function to read a question list: one question per line, or a CSV with a "question" column
+def read_questions(file, file_name):
+    file.seek(0)
+    text = file.read()
+    if isinstance(text, bytes):
+        text = text.decode("utf-8-sig")
+    if file_name.lower().endswith(".csv"):
+        rows = list(csv.reader(io.StringIO(text)))
+        if not rows:
+            return []
+        header = [cell.strip().lower() for cell in rows[0]]
+        column = header.index("question") if "question" in header else 0
+        rows = rows[1:] if "question" in header else rows
+        questions = [row[column] for row in rows if len(row) > column]
+    else:
+        questions = text.splitlines()
+    return [question.strip() for question in questions if question.strip()]
+
+
+# Function to render batch records as one consolidated file: JSON lines with the result rows,
+# or a CSV with one row per question and its timings
+def format_batch_results(records, output_format="jsonl"):
+    if output_format == "jsonl":
+        return "".join(json.dumps(record) + "\n" for record in records)
+    summary = pd.DataFrame([{
+        "question": record["question"],
+        "status": record["status"],
+        "sql": record["sql"],
+        "row_count": record["row_count"],
+        "answer": record["answer"],
+        "error": record["error"],
+        "attempts": record["attempts"],
+        **{f"{stage}_seconds": round(seconds, 3) for stage, seconds in record["timings"].items()},
+    } for record in records])
+    if "row_count" in summary:
+        summary["row_count"] = summary["row_count"].astype("Int64")
+    return summary.to_csv(index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a list of questions against a dataset")
+    parser.add_argument("questions", help="text file with one question per line, or a CSV with a 'question' column")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="CSV or Excel file to load (reused if already loaded)")
+    source.add_argument("--dataset", help="fingerprint of an already loaded dataset")
+    parser.add_argument("--output", required=True, help="output file; .csv for a summary, otherwise JSON lines")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--no-summary", action="store_true", help="skip the LLM summary of each answer")
+    args = parser.parse_args()
+
+    migrate_database()
+    if args.data:
+        with open(args.data, "rb") as file:
+            fingerprint = file_fingerprint(file)
+            if lookup_dataset(fingerprint, DATABASE_PATH) is None:
+                ingest_upload(file, fingerprint, DATABASE_PATH)
+    else:
+        fingerprint = args.dataset
+    tables = get_dataset_tables(fingerprint)
+    if tables is None:
+        parser.error(f"Dataset {fingerprint} is not loaded")
+
+    with open(args.questions, "rb") as file:
+        questions = read_questions(file, args.questions)
+
+    started = time.perf_counter()
+    records = [None] * len(questions)
+    for done, (index, record) in enumerate(iter_batch(questions, tables, args.concurrency, not args.no_summary), start=1):
+        records[index] = record
+        print(f"[{done}/{len(questions)}] {record['status']} {record['timings']['total']:.2f}s {record['question']}")
+    output_format = "csv" if args.output.lower().endswith(".csv") else "jsonl"
+    with open(args.output, "w", encoding="utf-8", newline="") as file:
+        file.write(format_batch_results(records, output_format))
+    failed = sum(record["status"] != "ok" for record in records)
+    print(f"Answered {len(records) - failed}/{len(records)} questions in {time.perf_counter() - started:.1f}s; wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
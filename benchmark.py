@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import functools
+import contextlib
+import numpy as np
+import pandas as pd
+from db import migrate_database, DATABASE_PATH
+from llm import set_chat_model_factory
+from fake_llm import FakeChatModel
+from datasets import dataframe_fingerprint, ingest_dataframe_dataset
+from query_governor import run_governed_query
+from pipeline import run_query
+from result_cache import clear_result_cache
+from sql_cache import invalidate_sql_cache
+from chat_history import save_chat_history, flush_chat_history, load_chat_history, load_chat_messages, list_chats
+from metrics import flush_spans
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BENCHMARK_SIZES = (10_000, 1_000_000, 10_000_000)
+BENCHMARK_REPEATS = 5
+
+REGIONS = np.array(["North", "South", "East", "West", "Central"])
+PRODUCTS = np.array([f"Product {index:03d}" for index in range(200)])
+
+# Representative analytical queries over the synthetic sales table; {table} is the dataset table
+QUERIES = {
+    "group_by_sum": "SELECT region, SUM(quantity * price) AS revenue FROM {table} GROUP BY region ORDER BY revenue DESC",
+    "top_n": "SELECT product, SUM(quantity) AS units FROM {table} GROUP BY product ORDER BY units DESC LIMIT 10",
+    "monthly_trend": "SELECT strftime('%Y-%m', order_date) AS month, COUNT(*) AS orders, AVG(price) AS avg_price "
+                     "FROM {table} WHERE order_date >= '2023-01-01' GROUP BY month ORDER BY month",
+    "count_distinct": "SELECT region, COUNT(DISTINCT customer_id) AS customers FROM {table} GROUP BY region",
+    "key_lookup": "SELECT * FROM {table} WHERE customer_id = 4242",
+    "wide_filter": "SELECT * FROM {table} WHERE quantity >= 9 AND price > 90",
+}
+
+# Questions asked end to end, with the SQL the fake model answers them with
+QUESTIONS = {
+    "What is the revenue per region?": QUERIES["group_by_sum"],
+    "Which are the ten best selling products?": QUERIES["top_n"],
+    "How many orders were placed each month since 2023?": QUERIES["monthly_trend"],
+    "How many customers does each region have?": QUERIES["count_distinct"],
+}
+
+
+# Function to build a deterministic synthetic sales table of the given size
+def synthetic_sales(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "order_id": np.arange(rows, dtype=np.int64),
+        "order_date": pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 3 * 365, rows), unit="D"),
+        "region": REGIONS[rng.integers(0, len(REGIONS), rows)],
+        "product": PRODUCTS[rng.integers(0, len(PRODUCTS), rows)],
+        "customer_id": rng.integers(0, max(rows // 20, 1), rows),
+        "quantity": rng.integers(1, 11, rows),
+        "price": rng.uniform(1, 100, rows).round(2),
+    })
+
+
+def summarize_timings(seconds):
+    seconds = np.asarray(seconds, dtype=float)
+    return {
+        "count": len(seconds),
+        "p50_ms": float(np.percentile(seconds, 50) * 1000),
+        "p95_ms": float(np.percentile(seconds, 95) * 1000),
+        "mean_ms": float(seconds.mean() * 1000),
+        "min_ms": float(seconds.min() * 1000),
+        "max_ms": float(seconds.max() * 1000),
+    }
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+# Function to get the size of the database including its write-ahead log, which holds recent commits
+def database_size():
+    paths = (DATABASE_PATH, DATABASE_PATH + "-wal")
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+# Function to time loading a frame as a dataset: fingerprint it, then ingest it
+def benchmark_ingestion(rows):
+    df = synthetic_sales(rows)
+    fingerprint, fingerprint_seconds = timed(dataframe_fingerprint, df)
+    tables, ingest_seconds = timed(ingest_dataframe_dataset, df, fingerprint, DATABASE_PATH)
+    total = fingerprint_seconds + ingest_seconds
+    return tables[0]["table"], {
+        "rows": rows,
+        "columns": len(df.columns),
+        "fingerprint_seconds": fingerprint_seconds,
+        "ingest_seconds": ingest_seconds,
+        "total_seconds": total,
+        "rows_per_second": rows / total if total > 0 else float(rows),
+        "database_bytes": database_size(),
+    }
+
+
+# Function to time each representative query through the governor, plus a repeat through the result cache
+def benchmark_queries(table, rows, repeats=BENCHMARK_REPEATS):
+    results = []
+    for name, template in QUERIES.items():
+        sql = template.format(table=table)
+        timings = []
+        result = None
+        for _ in range(repeats):
+            result, seconds = timed(run_governed_query, sql, DATABASE_PATH)
+            timings.append(seconds)
+        run_query(sql, [table])
+        _, cached_seconds = timed(run_query, sql, [table])
+        results.append({
+            "table_rows": rows,
+            "query": name,
+            "result_rows": len(result),
+            "truncated": bool(result.attrs.get("truncated")),
+            "indexes": result.attrs.get("indexes", []),
+            **summarize_timings(timings),
+            "cached_ms": cached_seconds * 1000,
+        })
+    return results
+
+
+# Function to time chat history writes through the background writer and the paged and full reads
+def benchmark_chat_history(turns, chats=10, repeats=BENCHMARK_REPEATS):
+    chat_ids = [str(uuid.uuid4()) for _ in range(chats)]
+    answer = {"answer": "- The query returned **42** rows.", "result": {"result_id": uuid.uuid4().hex, "rows": 42}}
+    started = time.perf_counter()
+    for turn in range(turns):
+        save_chat_history(chat_ids[turn % chats], f"Question {turn}", answer)
+    queued_seconds = time.perf_counter() - started
+    flush_chat_history()
+    write_seconds = time.perf_counter() - started
+
+    full_reads = [timed(load_chat_history, chat_id)[1] for chat_id in chat_ids[:repeats]]
+    page_reads = [timed(load_chat_messages, chat_id)[1] for chat_id in chat_ids[:repeats]]
+    list_reads = [timed(list_chats)[1] for _ in range(repeats)]
+    return {
+        "turns": turns,
+        "chats": chats,
+        "queue_turns_per_second": turns / queued_seconds if queued_seconds > 0 else float(turns),
+        "write_turns_per_second": turns / write_seconds if write_seconds > 0 else float(turns),
+        "load_chat_history": summarize_timings(full_reads),
+        "load_chat_messages": summarize_timings(page_reads),
+        "list_chats": summarize_timings(list_reads),
+    }
+
+
+# Function to time process_user_input end to end by asking questions through the Streamlit app.
+# Each question is asked twice: cold, then again with the SQL and result caches warm.
+def benchmark_end_to_end(table, rows, preview):
+    from streamlit.testing.v1 import AppTest
+
+    # benchmark_queries has already run these queries, so empty the caches to keep the cold phase cold
+    clear_result_cache()
+    invalidate_sql_cache([table])
+
+    app = AppTest.from_file(APP_PATH, default_timeout=600)
+    app.session_state["api_key_validated"] = True
+    app.session_state["dataset"] = {"fingerprint": None, "file_name": None,
+                                    "tables": [{"table": table, "sheet": None, "rows": rows, "preview": preview}]}
+    app.run()
+    results = {"table_rows": rows, "questions": len(QUESTIONS)}
+    for phase in ("cold", "warm"):
+        timings = []
+        for question in QUESTIONS:
+            _, seconds = timed(app.chat_input[0].set_value(question).run)
+            if len(app.exception) or len(app.error):
+                failure = (app.exception or app.error)[0].value
+                raise RuntimeError(f"The app failed on {question!r}: {failure}")
+            timings.append(seconds)
+        results[phase] = summarize_timings(timings)
+    return results
+
+
+def parse_sizes(value):
+    return [int(size.replace("_", "")) for size in value.split(",") if size.strip()]
+
+
+# Function to run every benchmark against the current directory's databases with the fake model installed
+def run_benchmarks(args):
+    migrate_database()
+    set_chat_model_factory(functools.partial(
+        FakeChatModel, sql=QUESTIONS, first_token_seconds=args.llm_latency, token_seconds=args.token_latency))
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {"sizes": args.sizes, "repeats": args.repeats, "chat_turns": args.chat_turns,
+                     "llm_latency": args.llm_latency, "token_latency": args.token_latency},
+        "ingestion": [],
+        "queries": [],
+    }
+    smallest = None
+    for rows in sorted(args.sizes):
+        print(f"Ingesting {rows} rows")
+        table, stats = benchmark_ingestion(rows)
+        report["ingestion"].append(stats)
+        print(f"Querying {rows} rows")
+        report["queries"].extend(benchmark_queries(table, rows, args.repeats))
+        smallest = smallest or (table, rows)
+
+    print("Chat history")
+    report["chat_history"] = benchmark_chat_history(args.chat_turns, repeats=args.repeats)
+    if not args.skip_end_to_end and smallest is not None:
+        print("End to end")
+        table, rows = smallest
+        report["end_to_end"] = benchmark_end_to_end(table, rows, synthetic_sales(5))
+    flush_spans()
+    flush_chat_history()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline DataDialogue benchmarks with a fake LLM; prints JSON")
+    parser.add_argument("--sizes", type=parse_sizes, default=list(BENCHMARK_SIZES), help="comma-separated table sizes to ingest")
+    parser.add_argument("--repeats", type=int, default=BENCHMARK_REPEATS, help="runs per timed query or read")
+    parser.add_argument("--chat-turns", type=int, default=10_000, help="chat history turns to write")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="fake model seconds to the first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="fake model seconds per token")
+    parser.add_argument("--skip-end-to-end", action="store_true", help="skip the Streamlit process_user_input run")
+    parser.add_argument("--workdir", help="directory for the benchmark databases (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="datadialogue-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    # The database paths are relative, so the whole run happens inside the work directory
+    original_dir = os.getcwd()
+    os.chdir(workdir)
+    # Progress and migration messages go to stderr so stdout carries only the JSON report
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_benchmarks(args)
+    finally:
+        set_chat_model_factory(None)
+        os.chdir(original_dir)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, default=str)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
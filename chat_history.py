@@ -0,0 +1,219 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from db import get_connection, close_connections, CHAT_HISTORY_PATH
+from metrics import span
+
+# Default page sizes for the keyset-paginated APIs
+CHATS_PAGE_SIZE = 20
+MESSAGES_PAGE_SIZE = 50
+
+# Write-behind settings: queued rows are written in batches at least every WRITE_FLUSH_INTERVAL seconds
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_INTERVAL = 0.5
+
+# Sentinel telling the writer thread to drain its batch and exit
+_STOP = object()
+# Sentinel telling the writer thread to write its batch now because a reader is waiting for it
+_FLUSH = object()
+
+
+def insert_chat_rows(conn, rows):
+    with conn:
+        conn.executemany("INSERT INTO chat_history (id, chat_id, user_input, bot_response, timestamp) VALUES (?, ?, ?, ?, ?)", rows)
+
+
+# Background writer that batches chat history inserts into grouped transactions,
+# so saving a turn never waits on a disk sync
+class ChatHistoryWriter:
+    def __init__(self, db_path=CHAT_HISTORY_PATH, max_queue=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        # Rows are numbered as they are queued; readers wait for the number they saw, not for an empty queue
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.written_changed = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self.thread.start()
+
+    # Returns False if the queue is full, in which case the caller should write the row itself
+    def submit(self, row):
+        with self.lock:
+            try:
+                self.queue.put_nowait((self.submitted + 1, row))
+            except queue.Full:
+                return False
+            self.submitted += 1
+            return True
+
+    # Block until every row submitted before this call has been written. Rows other sessions
+    # submit in the meantime are not waited for, so reads finish under sustained writes.
+    def flush(self):
+        with self.lock:
+            target = self.submitted
+        with self.written_changed:
+            if self.written >= target:
+                return
+        try:
+            # Cut the writer's batching window short rather than wait out the flush interval
+            self.queue.put_nowait(_FLUSH)
+        except queue.Full:
+            pass
+        with self.written_changed:
+            self.written_changed.wait_for(lambda: self.written >= target or not self.thread.is_alive())
+
+    def close(self, timeout=10):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [item]
+            # Group whatever arrives within one flush interval into the same transaction
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _FLUSH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            entries = [item for item in batch if item is not _STOP and item is not _FLUSH]
+            stopping = any(item is _STOP for item in batch)
+            try:
+                if entries:
+                    insert_chat_rows(get_connection(self.db_path), [row for _, row in entries])
+            except sqlite3.Error as e:
+                print(f"An error occurred: {e}")
+            finally:
+                if entries:
+                    with self.written_changed:
+                        self.written = entries[-1][0]
+                        self.written_changed.notify_all()
+        close_connections()
+        # Release any reader still waiting once the writer has stopped
+        with self.written_changed:
+            self.written_changed.notify_all()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_chat_history_writer(db_path=CHAT_HISTORY_PATH):
+    with _writers_lock:
+        writer = _writers.get(db_path)
+        if writer is None:
+            writer = _writers[db_path] = ChatHistoryWriter(db_path)
+            atexit.register(writer.close)
+        return writer
+
+
+# Function to wait for queued chat history writes to reach the database
+def flush_chat_history(db_path=CHAT_HISTORY_PATH):
+    writer = _writers.get(db_path)
+    if writer is not None:
+        writer.flush()
+
+
+# Function to save chat history to database; the insert is queued for the background writer
+def save_chat_history(chat_id, user_input, bot_response):
+    # Insert new chat entry
+    entry_id = str(uuid.uuid4())
+    # Stamp the row now so batching does not change the order of turns
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+    # Convert all inputs to strings
+    row = (entry_id, str(chat_id), str(user_input), str(bot_response), timestamp)
+
+    with span("save_chat_history"):
+        if not get_chat_history_writer().submit(row):
+            # The queue is full: apply backpressure by writing synchronously rather than dropping the turn
+            try:
+                insert_chat_rows(get_connection(CHAT_HISTORY_PATH), [row])
+            except sqlite3.Error as e:
+                print(f"An error occurred: {e}")
+
+# Function to load chat history from database
+def load_chat_history(chat_id):
+    flush_chat_history()
+    conn = get_connection(CHAT_HISTORY_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT user_input, bot_response FROM chat_history WHERE chat_id = ? ORDER BY timestamp, rowid", (chat_id,))
+    history = cursor.fetchall()
+
+    return history
+
+# Function to load one page of a conversation, newest page first.
+# Pass the returned cursor as `before` to fetch the next older page; it is None on the last page.
+def load_chat_messages(chat_id, limit=MESSAGES_PAGE_SIZE, before=None):
+    flush_chat_history()
+    conn = get_connection(CHAT_HISTORY_PATH)
+    if before is None:
+        rows = conn.execute(
+            "SELECT rowid, user_input, bot_response, timestamp FROM chat_history WHERE chat_id = ? "
+            "ORDER BY timestamp DESC, rowid DESC LIMIT ?", (chat_id, limit)).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT rowid, user_input, bot_response, timestamp FROM chat_history WHERE chat_id = ? "
+            "AND (timestamp, rowid) < (?, ?) ORDER BY timestamp DESC, rowid DESC LIMIT ?",
+            (chat_id, before[0], before[1], limit)).fetchall()
+    next_cursor = (rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+    # Return the page in chronological order
+    messages = [(user_input, bot_response, timestamp) for _, user_input, bot_response, timestamp in reversed(rows)]
+    return messages, next_cursor
+
+# Function to list chats by most recent activity, one page at a time.
+# Pass the returned cursor as `before` to fetch the next page; it is None on the last page.
+def list_chats(limit=CHATS_PAGE_SIZE, before=None):
+    flush_chat_history()
+    conn = get_connection(CHAT_HISTORY_PATH)
+    if before is None:
+        rows = conn.execute(
+            "SELECT chat_id, last_activity, message_count FROM chat_summary "
+            "ORDER BY last_activity DESC, chat_id DESC LIMIT ?", (limit,)).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT chat_id, last_activity, message_count FROM chat_summary "
+            "WHERE (last_activity, chat_id) < (?, ?) ORDER BY last_activity DESC, chat_id DESC LIMIT ?",
+            (before[0], before[1], limit)).fetchall()
+    next_cursor = (rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+    chats = [{"chat_id": chat_id, "last_activity": last_activity, "message_count": message_count}
+             for chat_id, last_activity, message_count in rows]
+    return chats, next_cursor
+
+# Function to get all chat IDs, most recently active first
+def get_all_chat_ids():
+    flush_chat_history()
+    conn = get_connection(CHAT_HISTORY_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT chat_id FROM chat_summary ORDER BY last_activity DESC, chat_id DESC")
+    chat_ids = cursor.fetchall()
+
+    return [chat_id[0] for chat_id in chat_ids]
+
+# Function to delete a chat
+def delete_chat(chat_id):
+    flush_chat_history()
+    conn = get_connection(CHAT_HISTORY_PATH)
+    cursor = conn.cursor()
+
+    with conn:
+        cursor.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
@@ -0,0 +1,160 @@
+import json
+import numpy as np
+import pandas as pd
+from collections import Counter
+from db import get_connection, DATABASE_PATH
+
+# Sketch sizes for the streaming column profile
+DISTINCT_SKETCH_SIZE = 1024
+TOP_VALUE_CANDIDATES = 200
+TOP_VALUES = 10
+HISTOGRAM_SAMPLE_SIZE = 10000
+HISTOGRAM_BINS = 10
+
+_rng = np.random.default_rng()
+
+
+def to_json_value(value, date_format=None):
+    if isinstance(value, pd.Timestamp) and date_format is not None:
+        return value.strftime(date_format)
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating,)):
+        return float(value)
+    if isinstance(value, (np.bool_,)):
+        return bool(value)
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat(sep=" ")
+    return value if isinstance(value, (int, float, str, bool)) or value is None else str(value)
+
+
+# Accumulates one column's profile across chunks with bounded memory:
+# a k-minimum-values sketch for distinct counts, pruned counters for top values
+# and a bottom-k random sample for the histogram.
+class ColumnProfile:
+    def __init__(self, name, col_type, date_format=None):
+        self.name = name
+        self.col_type = col_type
+        self.date_format = date_format
+        self.row_count = 0
+        self.null_count = 0
+        self.min_value = None
+        self.max_value = None
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.top = Counter()
+        self.sample_keys = np.empty(0)
+        self.sample_values = np.empty(0)
+        self.sampled_count = 0
+
+    def update(self, series):
+        self.row_count += len(series)
+        values = series.dropna()
+        self.null_count += len(series) - len(values)
+        if values.empty:
+            return
+        numeric = self.col_type in ("INTEGER", "REAL")
+        if numeric:
+            values = pd.to_numeric(values, errors="coerce").dropna()
+            # inf (read_csv parses the text "inf") would make the histogram range infinite
+            values = values[np.isfinite(values.to_numpy(dtype=float))]
+        elif self.col_type in ("DATE", "TIMESTAMP"):
+            # Imported here because ingest imports this module; parsing the same way keeps min/max in line with the stored values
+            from ingest import parse_dates
+            values = parse_dates(values).dropna()
+        else:
+            values = values.astype(str)
+        if values.empty:
+            return
+
+        low, high = values.min(), values.max()
+        self.min_value = low if self.min_value is None else min(self.min_value, low)
+        self.max_value = high if self.max_value is None else max(self.max_value, high)
+
+        counts = values.value_counts()
+        # Only the smallest distinct hashes matter for the sketch, so partition before merging
+        hashes = pd.util.hash_array(counts.index.to_numpy())
+        if len(hashes) > DISTINCT_SKETCH_SIZE:
+            hashes = np.partition(hashes, DISTINCT_SKETCH_SIZE - 1)[:DISTINCT_SKETCH_SIZE]
+        self.hashes = np.unique(np.concatenate([self.hashes, hashes]))[:DISTINCT_SKETCH_SIZE]
+
+        self.top.update(counts.head(TOP_VALUE_CANDIDATES).to_dict())
+        if len(self.top) > TOP_VALUE_CANDIDATES:
+            self.top = Counter(dict(self.top.most_common(TOP_VALUE_CANDIDATES)))
+
+        if numeric:
+            self.sampled_count += len(values)
+            keys = np.concatenate([self.sample_keys, _rng.random(len(values))])
+            sample = np.concatenate([self.sample_values, values.to_numpy(dtype=float)])
+            if len(keys) > HISTOGRAM_SAMPLE_SIZE:
+                keep = np.argpartition(keys, HISTOGRAM_SAMPLE_SIZE)[:HISTOGRAM_SAMPLE_SIZE]
+                keys, sample = keys[keep], sample[keep]
+            self.sample_keys, self.sample_values = keys, sample
+
+    def distinct_estimate(self):
+        if len(self.hashes) < DISTINCT_SKETCH_SIZE:
+            return len(self.hashes)
+        kth = float(self.hashes[-1]) / float(np.iinfo(np.uint64).max)
+        return int((DISTINCT_SKETCH_SIZE - 1) / kth)
+
+    def histogram(self):
+        if not len(self.sample_values):
+            return None
+        counts, edges = np.histogram(self.sample_values, bins=HISTOGRAM_BINS,
+                                     range=(float(self.min_value), float(self.max_value)))
+        # Scale the sample counts up to the number of finite values the sample was drawn from
+        scale = self.sampled_count / len(self.sample_values)
+        return [{"low": float(edges[i]), "high": float(edges[i + 1]), "count": int(round(counts[i] * scale))}
+                for i in range(len(counts))]
+
+    def finish(self, position):
+        return {
+            "column": self.name,
+            "position": position,
+            "type": self.col_type,
+            "row_count": self.row_count,
+            "null_count": self.null_count,
+            "null_ratio": self.null_count / self.row_count if self.row_count else 0.0,
+            "distinct_estimate": self.distinct_estimate(),
+            "min": to_json_value(self.min_value, self.date_format),
+            "max": to_json_value(self.max_value, self.date_format),
+            "top_values": [[to_json_value(value, self.date_format), int(count)]
+                           for value, count in self.top.most_common(TOP_VALUES)],
+            "histogram": self.histogram(),
+        }
+
+
+# Profiles every column of a table; date values are reported in the format they are stored in
+class TableProfile:
+    def __init__(self, column_types, date_formats=None):
+        date_formats = date_formats or {}
+        self.columns = [ColumnProfile(name, col_type, date_formats.get(col_type)) for name, col_type in column_types.items()]
+
+    def update(self, chunk):
+        for column, (_, series) in zip(self.columns, chunk.items()):
+            column.update(series)
+
+    def finish(self):
+        return [column.finish(position) for position, column in enumerate(self.columns)]
+
+
+# Function to persist a table's profile into the catalog; runs inside the ingest transaction
+def save_profile(cursor, table_name, profile):
+    cursor.execute("DELETE FROM column_profiles WHERE table_name = ?", (table_name,))
+    cursor.executemany(
+        "INSERT INTO column_profiles (table_name, column_name, position, col_type, row_count, null_count, null_ratio, "
+        "distinct_estimate, min_value, max_value, top_values, histogram) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(table_name, p["column"], p["position"], p["type"], p["row_count"], p["null_count"], p["null_ratio"],
+          p["distinct_estimate"], json.dumps(p["min"]), json.dumps(p["max"]), json.dumps(p["top_values"]),
+          json.dumps(p["histogram"])) for p in profile])
+
+
+# Function to read the stored profile of the given tables
+def load_profile(tables, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    placeholders = ', '.join(['?'] * len(tables))
+    profile_df = pd.read_sql(
+        f"SELECT * FROM column_profiles WHERE table_name IN ({placeholders}) ORDER BY table_name, position",
+        con=conn, params=tuple(tables))
+    for col in ("min_value", "max_value", "top_values", "histogram"):
+        profile_df[col] = profile_df[col].map(json.loads)
+    return profile_df
@@ -0,0 +1,182 @@
+import os
+import time
+import hashlib
+import sqlite3
+import pandas as pd
+from db import get_connection, DATABASE_PATH
+from sql_cache import invalidate_sql_cache
+from index_advisor import create_key_indexes, forget_tables
+from sampling import create_sample_table, forget_samples
+from ingest import quote_identifier, ingest_chunks, ingest_dataframe, read_file_tables, PREVIEW_ROWS
+
+# Bytes read per step while hashing an upload
+HASH_BLOCK_SIZE = 1 << 20
+
+# Budget for the shared dataset store; idle datasets are evicted least recently used first
+DATASET_DISK_BUDGET_MB = int(os.environ.get("DATADIALOGUE_DATASET_BUDGET_MB", "2048"))
+DATASET_MAX_COUNT = int(os.environ.get("DATADIALOGUE_MAX_DATASETS", "50"))
+# Datasets used more recently than this are never evicted, so active sessions keep their tables
+DATASET_IDLE_SECONDS = int(os.environ.get("DATADIALOGUE_DATASET_IDLE_SECONDS", "900"))
+
+
+# Function to fingerprint an uploaded file by its content
+def file_fingerprint(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+# Function to fingerprint an in-memory DataFrame by its content
+def dataframe_fingerprint(df):
+    digest = hashlib.sha256()
+    digest.update(",".join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+# Tables are named after the content they hold, so identical uploads from different
+# sessions share one table and different uploads never overwrite each other
+def dataset_table_name(fingerprint, index=0):
+    return f"ds_{fingerprint[:16]}_{index}"
+
+
+def table_size(conn, table_name):
+    try:
+        return conn.execute("SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name = ?", (table_name,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        # dbstat is not compiled into every SQLite build; estimate from the page count instead
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        tables = max(conn.execute("SELECT COUNT(*) FROM datasets").fetchone()[0], 1)
+        return page_size * page_count // tables
+
+
+def read_preview(conn, table_name):
+    return pd.read_sql(f"SELECT * FROM {quote_identifier(table_name)} LIMIT {PREVIEW_ROWS}", con=conn)
+
+
+# Function to find the already ingested tables holding the same content
+def lookup_dataset(fingerprint, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    rows = conn.execute(
+        "SELECT d.table_name, d.file_name, d.sheet_name, d.row_count FROM datasets d "
+        "JOIN sqlite_master m ON m.type = 'table' AND m.name = d.table_name "
+        "WHERE d.fingerprint = ? ORDER BY d.table_name", (fingerprint,)).fetchall()
+    if not rows:
+        return None
+    with conn:
+        conn.execute("UPDATE datasets SET last_used_at = ? WHERE fingerprint = ?", (time.time(), fingerprint))
+    tables = [{"table": table_name, "sheet": sheet_name, "rows": row_count, "preview": read_preview(conn, table_name)}
+              for table_name, _, sheet_name, row_count in rows]
+    return {"fingerprint": fingerprint, "file_name": rows[0][1], "tables": tables}
+
+
+# Function to record which content a table was loaded from
+def record_dataset(table_name, fingerprint, file_name, row_count, sheet_name=None, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    invalidate_sql_cache([table_name], db_path)
+    with conn:
+        version = conn.execute("INSERT INTO dataset_versions (table_name) VALUES (?)", (table_name,)).lastrowid
+        conn.execute("INSERT OR REPLACE INTO datasets (table_name, fingerprint, file_name, sheet_name, row_count, size_bytes, "
+                     "last_used_at, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (table_name, fingerprint, file_name, sheet_name, row_count, table_size(conn, table_name), time.time(), version))
+
+
+# Function to list the registered datasets and their tables, most recently used first
+def list_datasets(db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    datasets = {}
+    for fingerprint, file_name, table_name, sheet_name, row_count in conn.execute(
+            "SELECT fingerprint, file_name, table_name, sheet_name, row_count FROM datasets "
+            "ORDER BY MAX(COALESCE(last_used_at, 0)) OVER (PARTITION BY fingerprint) DESC, fingerprint, table_name"):
+        dataset = datasets.setdefault(fingerprint, {"fingerprint": fingerprint, "file_name": file_name, "tables": []})
+        dataset["tables"].append({"table": table_name, "sheet": sheet_name, "rows": row_count})
+    return list(datasets.values())
+
+
+# Function to get the table names of a dataset, or None if it is not loaded
+def get_dataset_tables(fingerprint, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    tables = [row[0] for row in conn.execute("SELECT table_name FROM datasets WHERE fingerprint = ? ORDER BY table_name",
+                                             (fingerprint,))]
+    return tables or None
+
+
+# Function to get a version tag for a set of tables; it changes whenever any of them is reloaded
+def get_dataset_version(table_names, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    placeholders = ', '.join(['?'] * len(table_names))
+    rows = conn.execute(f"SELECT table_name, version FROM datasets WHERE table_name IN ({placeholders}) ORDER BY table_name",
+                        tuple(table_names)).fetchall()
+    return ",".join(f"{table_name}:{version}" for table_name, version in rows)
+
+
+# Function to mark a session's tables as recently used; returns False if any were evicted
+def touch_dataset(table_names, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    placeholders = ', '.join(['?'] * len(table_names))
+    with conn:
+        cursor = conn.execute(f"UPDATE datasets SET last_used_at = ? WHERE table_name IN ({placeholders})",
+                              (time.time(), *table_names))
+    return cursor.rowcount == len(table_names)
+
+
+# Function to drop idle datasets, least recently used first, until the store fits its budget
+def evict_datasets(keep=(), db_path=DATABASE_PATH, budget_mb=DATASET_DISK_BUDGET_MB,
+                   max_count=DATASET_MAX_COUNT, idle_seconds=DATASET_IDLE_SECONDS):
+    conn = get_connection(db_path)
+    evicted = []
+    datasets = conn.execute(
+        "SELECT fingerprint, SUM(size_bytes), MAX(COALESCE(last_used_at, 0)) FROM datasets "
+        "GROUP BY fingerprint ORDER BY MAX(COALESCE(last_used_at, 0))").fetchall()
+    total_bytes = sum(size for _, size, _ in datasets)
+    count = len(datasets)
+    idle_cutoff = time.time() - idle_seconds
+    for fingerprint, size, last_used_at in datasets:
+        if total_bytes <= budget_mb * 1024 * 1024 and count <= max_count:
+            break
+        if fingerprint in keep or last_used_at > idle_cutoff:
+            continue
+        tables = [row[0] for row in conn.execute("SELECT table_name FROM datasets WHERE fingerprint = ?", (fingerprint,))]
+        with conn:
+            for table_name in tables:
+                conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)}")
+                conn.execute("DELETE FROM column_profiles WHERE table_name = ?", (table_name,))
+            forget_tables(conn, tables)
+            forget_samples(conn, tables)
+            conn.execute("DELETE FROM datasets WHERE fingerprint = ?", (fingerprint,))
+        invalidate_sql_cache(tables, db_path)
+        total_bytes -= size
+        count -= 1
+        evicted.append(fingerprint)
+    return evicted
+
+
+# Function to stream an upload into its own tables, one per CSV file or Excel sheet
+def ingest_upload(file, fingerprint, db_path=DATABASE_PATH):
+    tables = []
+    for index, (sheet_name, chunks) in enumerate(read_file_tables(file)):
+        table_name = dataset_table_name(fingerprint, index)
+        stats = ingest_chunks(chunks, db_path, table_name)
+        create_key_indexes(table_name, db_path)
+        record_dataset(table_name, fingerprint, file.name, stats["rows"], sheet_name, db_path)
+        create_sample_table(table_name, stats["rows"], db_path)
+        stats["sheet"] = sheet_name
+        tables.append(stats)
+    evict_datasets(keep=(fingerprint,), db_path=db_path)
+    return tables
+
+
+# Function to load an in-memory DataFrame as a dataset of its own
+def ingest_dataframe_dataset(df, fingerprint, db_path=DATABASE_PATH):
+    table_name = dataset_table_name(fingerprint)
+    stats = ingest_dataframe(df, db_path, table_name)
+    create_key_indexes(table_name, db_path)
+    record_dataset(table_name, fingerprint, None, stats["rows"], None, db_path)
+    create_sample_table(table_name, stats["rows"], db_path)
+    stats["sheet"] = None
+    evict_datasets(keep=(fingerprint,), db_path=db_path)
+    return [stats]
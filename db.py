@@ -0,0 +1,254 @@
+import sqlite3
+import threading
+import weakref
+import uuid
+
+DATABASE_PATH = 'mydatabase.db'
+CHAT_HISTORY_PATH = 'chat_history.db'
+
+# How long a connection waits on a locked database before giving up
+BUSY_TIMEOUT_MS = 30000
+
+# Pragmas applied once to every pooled connection
+CONNECTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": str(BUSY_TIMEOUT_MS),
+    "foreign_keys": "ON",
+}
+
+# Connections left by threads that have exited, kept for the next thread that needs one.
+# Streamlit runs every rerun on a fresh thread, so without this each rerun would reconnect
+# and reapply the pragmas.
+MAX_IDLE_CONNECTIONS = 8
+
+_local = threading.local()
+_idle = {}
+_idle_lock = threading.Lock()
+
+
+# A thread's connections; its finalizer hands them to the idle pool when the thread's state is released
+class ThreadConnections:
+    def __init__(self):
+        self.connections = {}
+        weakref.finalize(self, release_connections, self.connections)
+
+
+# Function to return an exited thread's connections to the idle pool, closing any beyond its bound
+def release_connections(connections):
+    for db_path, conn in connections.items():
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            continue
+        with _idle_lock:
+            idle = _idle.setdefault(db_path, [])
+            if len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(conn)
+                continue
+        conn.close()
+    connections.clear()
+
+
+def open_connection(db_path):
+    # Connections move to another thread only after their owner has exited, never while in use
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    for pragma, value in CONNECTION_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+
+# Function to get this thread's pooled connection to a database. A thread takes a connection
+# from the idle pool on first use, or opens one, and keeps it for as long as it runs.
+def get_connection(db_path=DATABASE_PATH):
+    owned = getattr(_local, 'owned', None)
+    if owned is None:
+        owned = _local.owned = ThreadConnections()
+    conn = owned.connections.get(db_path)
+    if conn is None:
+        with _idle_lock:
+            idle = _idle.get(db_path)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = open_connection(db_path)
+        owned.connections[db_path] = conn
+    return conn
+
+
+# Function to close this thread's pooled connections instead of returning them to the idle pool
+def close_connections():
+    owned = getattr(_local, 'owned', None)
+    if owned is None:
+        return
+    for conn in owned.connections.values():
+        conn.close()
+    owned.connections.clear()
+
+
+def migrate_chat_history(conn):
+    cursor = conn.cursor()
+
+    # Check if the chat_history table exists
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chat_history'")
+    table_exists = cursor.fetchone()
+
+    if table_exists:
+        # Check if chat_id column exists
+        cursor.execute("PRAGMA table_info(chat_history)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'chat_id' not in columns:
+            # Add chat_id column
+            cursor.execute("ALTER TABLE chat_history ADD COLUMN chat_id TEXT")
+
+            # Update existing rows with a default chat_id
+            default_chat_id = str(uuid.uuid4())
+            cursor.execute("UPDATE chat_history SET chat_id = ? WHERE chat_id IS NULL", (default_chat_id,))
+
+            conn.commit()
+            print("Database migrated: added chat_id column")
+    else:
+        # Create the chat_history table with the correct schema
+        cursor.execute("""
+        CREATE TABLE chat_history
+        (id TEXT PRIMARY KEY, chat_id TEXT, user_input TEXT, bot_response TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
+        """)
+        conn.commit()
+        print("Database migrated: created chat_history table")
+
+    # Index conversations by (chat_id, timestamp) and keep a per-chat summary up to date with triggers
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_chat_ts ON chat_history (chat_id, timestamp)")
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chat_summary'")
+    summary_exists = cursor.fetchone()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS chat_summary
+    (chat_id TEXT PRIMARY KEY, first_activity DATETIME, last_activity DATETIME, message_count INTEGER NOT NULL DEFAULT 0)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_summary_last_activity ON chat_summary (last_activity, chat_id)")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_chat_history_insert AFTER INSERT ON chat_history
+    BEGIN
+        INSERT INTO chat_summary (chat_id, first_activity, last_activity, message_count)
+        VALUES (NEW.chat_id, NEW.timestamp, NEW.timestamp, 1)
+        ON CONFLICT(chat_id) DO UPDATE SET last_activity = MAX(last_activity, excluded.last_activity),
+                                           message_count = message_count + 1;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_chat_history_delete AFTER DELETE ON chat_history
+    BEGIN
+        UPDATE chat_summary SET message_count = message_count - 1 WHERE chat_id = OLD.chat_id;
+        DELETE FROM chat_summary WHERE chat_id = OLD.chat_id AND message_count <= 0;
+    END
+    """)
+    if not summary_exists:
+        # Backfill the summary from history recorded before it existed
+        cursor.execute("""
+        INSERT INTO chat_summary (chat_id, first_activity, last_activity, message_count)
+        SELECT chat_id, MIN(timestamp), MAX(timestamp), COUNT(*) FROM chat_history
+        WHERE chat_id IS NOT NULL GROUP BY chat_id
+        """)
+        print("Database migrated: created chat_summary table")
+    conn.commit()
+
+
+def migrate_dataset_registry(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS datasets
+    (table_name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, file_name TEXT, row_count INTEGER,
+     ingested_at DATETIME DEFAULT CURRENT_TIMESTAMP, sheet_name TEXT, size_bytes INTEGER DEFAULT 0,
+     last_used_at REAL, version INTEGER)
+    """)
+    # Every ingest draws a new version from this sequence; AUTOINCREMENT never reuses a number
+    conn.execute("CREATE TABLE IF NOT EXISTS dataset_versions (version INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT)")
+    # Registries created before the store tracked usage lack the eviction columns
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(datasets)").fetchall()]
+    for column, column_type in [("sheet_name", "TEXT"), ("size_bytes", "INTEGER DEFAULT 0"), ("last_used_at", "REAL"),
+                                ("version", "INTEGER")]:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE datasets ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_datasets_fingerprint ON datasets (fingerprint)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_datasets_last_used ON datasets (last_used_at)")
+    conn.commit()
+
+
+def migrate_sql_cache(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sql_cache
+    (cache_key TEXT PRIMARY KEY, schema_hash TEXT NOT NULL, tables TEXT NOT NULL, question TEXT, sql TEXT NOT NULL,
+     created_at REAL NOT NULL, last_used_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sql_cache_last_used ON sql_cache (last_used_at)")
+    conn.commit()
+
+
+def migrate_column_profiles(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS column_profiles
+    (table_name TEXT NOT NULL, column_name TEXT NOT NULL, position INTEGER, col_type TEXT, row_count INTEGER,
+     null_count INTEGER, null_ratio REAL, distinct_estimate INTEGER, min_value TEXT, max_value TEXT,
+     top_values TEXT, histogram TEXT, PRIMARY KEY (table_name, column_name))
+    """)
+    conn.commit()
+
+
+def migrate_index_advisor(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS index_workload
+    (table_name TEXT NOT NULL, column_name TEXT NOT NULL, kind TEXT NOT NULL, uses INTEGER NOT NULL DEFAULT 0,
+     last_used_at REAL, PRIMARY KEY (table_name, column_name, kind))
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS query_log
+    (id INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, columns TEXT NOT NULL, sql TEXT NOT NULL,
+     seconds REAL NOT NULL, indexes TEXT NOT NULL DEFAULT '', ran_at REAL NOT NULL)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_query_log_table ON query_log (table_name, ran_at)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS advisor_indexes
+    (index_name TEXT PRIMARY KEY, table_name TEXT NOT NULL, column_name TEXT NOT NULL, reason TEXT NOT NULL,
+     status TEXT NOT NULL, created_at REAL NOT NULL, before_seconds REAL, after_seconds REAL)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_advisor_indexes_table ON advisor_indexes (table_name)")
+    conn.commit()
+
+
+def migrate_metrics(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS metrics_spans
+    (id INTEGER PRIMARY KEY AUTOINCREMENT, turn_id TEXT, stage TEXT NOT NULL, started_at REAL NOT NULL, seconds REAL NOT NULL,
+     input_tokens INTEGER NOT NULL DEFAULT 0, output_tokens INTEGER NOT NULL DEFAULT 0, rows INTEGER, cache_hit INTEGER,
+     sql_hash TEXT, error TEXT)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_spans_started ON metrics_spans (started_at)")
+    conn.commit()
+
+
+def migrate_dataset_samples(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dataset_samples
+    (table_name TEXT PRIMARY KEY, sample_table TEXT NOT NULL, fraction REAL NOT NULL, row_count INTEGER NOT NULL,
+     created_at REAL NOT NULL)
+    """)
+    conn.commit()
+
+
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+# Function to migrate both databases; schema setup runs once per process
+def migrate_database(db_path=DATABASE_PATH, chat_history_path=CHAT_HISTORY_PATH):
+    with _migrate_lock:
+        if (db_path, chat_history_path) in _migrated:
+            return
+        migrate_chat_history(get_connection(chat_history_path))
+        migrate_dataset_registry(get_connection(db_path))
+        migrate_sql_cache(get_connection(db_path))
+        migrate_column_profiles(get_connection(db_path))
+        migrate_index_advisor(get_connection(db_path))
+        migrate_metrics(get_connection(db_path))
+        migrate_dataset_samples(get_connection(db_path))
+        _migrated.add((db_path, chat_history_path))
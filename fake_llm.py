@@ -0,0 +1,58 @@
+import re
+import time
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+# Canned summary returned for every answer prompt
+DEFAULT_SUMMARY = "- The query returned **{rows}** rows.\n\n- The largest group accounts for most of the total."
+# Default SQL when no canned query matches the question; {table} is the first table in the schema
+DEFAULT_SQL = "SELECT COUNT(*) AS row_count FROM {table}"
+
+TABLE_PATTERN = re.compile(r"^Table '([^']+)':", re.MULTILINE)
+QUESTION_PATTERN = re.compile(r"Generate a SQL query to answer the following question:\s*(.*?)\s*Return only the SQL query", re.DOTALL)
+ROW_COUNT_PATTERN = re.compile(r"(\d+) rows?\b")
+
+
+# Offline stand-in for ChatAnthropic with canned SQL and summaries and a configurable latency.
+# Install it with llm.set_chat_model_factory(functools.partial(FakeChatModel, ...)) for benchmarks
+# and demos that must not call the API; invoke() and stream() behave like the real client's.
+class FakeChatModel:
+    def __init__(self, sql=None, summary=DEFAULT_SUMMARY, first_token_seconds=0.0, token_seconds=0.0, **settings):
+        # sql maps a question to a query template, or is a callable (question, tables) -> SQL
+        self.sql = sql or {}
+        self.summary = summary
+        self.first_token_seconds = first_token_seconds
+        self.token_seconds = token_seconds
+        self.settings = settings
+
+    def respond(self, prompt):
+        prompt = prompt if isinstance(prompt, str) else str(prompt)
+        question = QUESTION_PATTERN.search(prompt)
+        if question is None:
+            rows = ROW_COUNT_PATTERN.search(prompt)
+            return self.summary.format(rows=rows.group(1) if rows else "several")
+        question = question.group(1)
+        tables = TABLE_PATTERN.findall(prompt)
+        if callable(self.sql):
+            return self.sql(question, tables)
+        template = self.sql.get(question, DEFAULT_SQL)
+        return template.format(table=tables[0] if tables else "my_table", tables=tables)
+
+    def usage(self, prompt, text):
+        # Rough token counts so the usage metrics have something to add up
+        return {"input_tokens": len(str(prompt)) // 4, "output_tokens": len(text.split()),
+                "total_tokens": len(str(prompt)) // 4 + len(text.split())}
+
+    def invoke(self, prompt, **kwargs):
+        text = self.respond(prompt)
+        time.sleep(self.first_token_seconds + self.token_seconds * len(text.split()))
+        return AIMessage(content=text, usage_metadata=self.usage(prompt, text))
+
+    def stream(self, prompt, **kwargs):
+        text = self.respond(prompt)
+        time.sleep(self.first_token_seconds)
+        words = text.split(" ")
+        for index, word in enumerate(words):
+            time.sleep(self.token_seconds)
+            yield AIMessageChunk(content=word if index == len(words) - 1 else word + " ")
+        # The real client reports usage on the final chunk
+        yield AIMessageChunk(content="", usage_metadata=self.usage(prompt, text))
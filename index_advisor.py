@@ -0,0 +1,324 @@
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import pandas as pd
+from db import get_connection, close_connections, DATABASE_PATH
+from ingest import quote_identifier
+from query_governor import run_governed_query, table_aliases, table_row_count, QueryRejectedError
+
+# Indexes are named by origin: key columns are indexed at ingest, the rest from the observed workload
+KEY_INDEX_PREFIX = "idx_key_"
+AUTO_INDEX_PREFIX = "idx_auto_"
+
+# A column is indexed once it appears in this many predicates or groupings of queries on a table
+# with at least INDEX_MIN_ROWS rows that took at least INDEX_MIN_QUERY_SECONDS
+INDEX_MIN_USES = int(os.environ.get("DATADIALOGUE_INDEX_MIN_USES", "3"))
+INDEX_MIN_ROWS = int(os.environ.get("DATADIALOGUE_INDEX_MIN_ROWS", "10000"))
+INDEX_MIN_QUERY_SECONDS = float(os.environ.get("DATADIALOGUE_INDEX_MIN_QUERY_SECONDS", "0.05"))
+# Columns with fewer distinct values than this are too unselective to be worth an index
+INDEX_MIN_DISTINCT = 10
+INDEX_MAX_PER_TABLE = 5
+# A new index is kept only if the queries that asked for it get at least this much faster
+INDEX_MIN_SPEEDUP = 1.5
+# Workload indexes whose columns have not been queried for this long are dropped
+INDEX_IDLE_SECONDS = int(os.environ.get("DATADIALOGUE_INDEX_IDLE_SECONDS", str(7 * 24 * 3600)))
+
+# Recent logged queries re-run to measure an index before and after it is built
+BENCHMARK_QUERIES = 3
+BENCHMARK_TIMEOUT_SECONDS = 10
+QUERY_LOG_MAX_ENTRIES = 10000
+ADVISOR_QUEUE_SIZE = 1000
+
+# Clauses whose columns an index can serve, each running up to the next clause keyword
+CLAUSE_PATTERN = re.compile(
+    r"\b(WHERE|ON|GROUP\s+BY)\b(.*?)(?=\b(?:WHERE|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|UNION|EXCEPT|INTERSECT|WINDOW|"
+    r"SELECT|FROM|(?:NATURAL\s+|LEFT\s+|RIGHT\s+|FULL\s+|INNER\s+|CROSS\s+|OUTER\s+)*JOIN)\b|;|$)",
+    re.IGNORECASE | re.DOTALL)
+IDENTIFIER = r'(?:"([^"]+)"|\[([^\]]+)\]|`([^`]+)`|([A-Za-z_]\w*))'
+# An identifier, optionally qualified by a table name or alias
+COLUMN_REFERENCE_PATTERN = re.compile(rf"{IDENTIFIER}(?:\s*\.\s*{IDENTIFIER})?")
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+
+# Sentinel telling the advisor thread to exit
+_STOP = object()
+
+
+def is_key_column(name):
+    return name.lower().endswith(('_id', '_dim_id'))
+
+
+def table_columns(conn, table_name):
+    return [(cid, name) for cid, name, *_ in conn.execute(f"PRAGMA table_info({quote_identifier(table_name)})")]
+
+
+# Function to get the leading column of every index on a table
+def indexed_columns(conn, table_name):
+    columns = set()
+    for _, index_name, *_ in conn.execute(f"PRAGMA index_list({quote_identifier(table_name)})").fetchall():
+        info = conn.execute(f"PRAGMA index_info({quote_identifier(index_name)})").fetchall()
+        if info:
+            columns.add(info[0][2].lower())
+    return columns
+
+
+def register_index(conn, index_name, table_name, column_name, reason, status, before_seconds=None, after_seconds=None):
+    conn.execute("INSERT OR REPLACE INTO advisor_indexes (index_name, table_name, column_name, reason, status, created_at, "
+                 "before_seconds, after_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                 (index_name, table_name, column_name, reason, status, time.time(), before_seconds, after_seconds))
+
+
+# Function to index the key-like columns of a freshly loaded table, so joins and lookups
+# on them never need a full scan
+def create_key_indexes(table_name, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    created = []
+    with conn:
+        for cid, column_name in table_columns(conn, table_name):
+            if not is_key_column(column_name):
+                continue
+            index_name = f"{KEY_INDEX_PREFIX}{table_name}_{cid}"
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {quote_identifier(index_name)} "
+                         f"ON {quote_identifier(table_name)} ({quote_identifier(column_name)})")
+            register_index(conn, index_name, table_name, column_name, "key", "active")
+            created.append(index_name)
+    return created
+
+
+# Function to find the columns a query filters, joins or groups on, per table.
+# Returns a set of (table_name, column_name, kind) with kind "predicate" or "group".
+def workload_columns(sql, columns_by_table):
+    sql = STRING_LITERAL_PATTERN.sub("''", sql)
+    aliases = {alias.lower(): table_name for alias, table_name in table_aliases(sql).items()}
+    lookup = {table_name: {name.lower(): name for _, name in columns} for table_name, columns in columns_by_table.items()}
+    used = set()
+    for clause, body in CLAUSE_PATTERN.findall(sql):
+        kind = "group" if clause.upper().startswith("GROUP") else "predicate"
+        for match in COLUMN_REFERENCE_PATTERN.finditer(body):
+            first = next(group for group in match.groups()[:4] if group is not None)
+            second = next((group for group in match.groups()[4:] if group is not None), None)
+            if second is not None:
+                qualifier, column = first, second
+                candidates = [aliases.get(qualifier.lower(), qualifier)]
+            else:
+                column = first
+                candidates = list(lookup)
+            for table_name in candidates:
+                name = lookup.get(table_name, {}).get(column.lower())
+                if name is not None:
+                    used.add((table_name, name, kind))
+    return used
+
+
+# Function to record which columns a query used and how long it took
+def record_workload(conn, sql, tables, seconds, indexes=()):
+    columns_by_table = {table_name: table_columns(conn, table_name) for table_name in tables}
+    used = workload_columns(sql, columns_by_table)
+    now = time.time()
+    per_table = {}
+    for table_name, column_name, _ in used:
+        per_table.setdefault(table_name, set()).add(column_name)
+    with conn:
+        conn.executemany(
+            "INSERT INTO index_workload (table_name, column_name, kind, uses, last_used_at) VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT (table_name, column_name, kind) DO UPDATE SET uses = uses + 1, last_used_at = excluded.last_used_at",
+            [(table_name, column_name, kind, now) for table_name, column_name, kind in used])
+        conn.executemany("INSERT INTO query_log (table_name, columns, sql, seconds, indexes, ran_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(table_name, json.dumps(sorted(columns)), sql, seconds, ",".join(indexes), now)
+                          for table_name, columns in per_table.items()])
+        conn.execute("DELETE FROM query_log WHERE id <= (SELECT MAX(id) FROM query_log) - ?", (QUERY_LOG_MAX_ENTRIES,))
+    return per_table
+
+
+# Function to pick the most recent distinct logged queries that used a column
+def benchmark_queries(conn, table_name, column_name, limit=BENCHMARK_QUERIES):
+    queries = {}
+    for sql, columns, seconds in conn.execute(
+            "SELECT sql, columns, seconds FROM query_log WHERE table_name = ? ORDER BY ran_at DESC LIMIT 200", (table_name,)):
+        if column_name in json.loads(columns) and sql not in queries:
+            queries[sql] = seconds
+            if len(queries) >= limit:
+                break
+    return queries
+
+
+# Function to time a set of queries; a query that times out counts as the full timeout
+def time_queries(queries, db_path=DATABASE_PATH):
+    timings = []
+    for sql in queries:
+        try:
+            timings.append(run_governed_query(sql, db_path, timeout_seconds=BENCHMARK_TIMEOUT_SECONDS).attrs["seconds"])
+        except QueryRejectedError:
+            timings.append(BENCHMARK_TIMEOUT_SECONDS)
+        except sqlite3.Error:
+            continue
+    return sum(timings) / len(timings) if timings else None
+
+
+# Function to build an index and keep it only if it measurably speeds up the queries that asked for it
+def build_index(conn, table_name, cid, column_name, queries, db_path=DATABASE_PATH):
+    before = time_queries(queries, db_path)
+    if before is None:
+        return False
+    index_name = f"{AUTO_INDEX_PREFIX}{table_name}_{cid}"
+    with conn:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {quote_identifier(index_name)} "
+                     f"ON {quote_identifier(table_name)} ({quote_identifier(column_name)})")
+    conn.execute("PRAGMA optimize")
+    after = time_queries(queries, db_path)
+    keep = after is not None and before >= after * INDEX_MIN_SPEEDUP
+    with conn:
+        if not keep:
+            conn.execute(f"DROP INDEX IF EXISTS {quote_identifier(index_name)}")
+        register_index(conn, index_name, table_name, column_name, "workload", "active" if keep else "rejected", before, after)
+    return keep
+
+
+# Function to build indexes for the columns a table's observed workload filters or groups on
+def advise_table(conn, table_name, db_path=DATABASE_PATH):
+    row_count = table_row_count(conn, table_name)
+    if row_count is None or row_count < INDEX_MIN_ROWS:
+        return []
+    statuses = dict(conn.execute("SELECT column_name, status FROM advisor_indexes WHERE table_name = ? AND reason = 'workload'",
+                                 (table_name,)).fetchall())
+    active = sum(status == "active" for status in statuses.values())
+    indexed = indexed_columns(conn, table_name)
+    distinct = dict(conn.execute("SELECT column_name, distinct_estimate FROM column_profiles WHERE table_name = ?",
+                                 (table_name,)).fetchall())
+    positions = {name: cid for cid, name in table_columns(conn, table_name)}
+    built = []
+    candidates = conn.execute("SELECT column_name, SUM(uses) FROM index_workload WHERE table_name = ? "
+                              "GROUP BY column_name HAVING SUM(uses) >= ? ORDER BY SUM(uses) DESC",
+                              (table_name, INDEX_MIN_USES)).fetchall()
+    for column_name, _ in candidates:
+        if active >= INDEX_MAX_PER_TABLE:
+            break
+        if column_name.lower() in indexed or statuses.get(column_name) == "rejected" or column_name not in positions:
+            continue
+        if (distinct.get(column_name) or INDEX_MIN_DISTINCT) < INDEX_MIN_DISTINCT:
+            continue
+        queries = benchmark_queries(conn, table_name, column_name)
+        if not queries or max(queries.values()) < INDEX_MIN_QUERY_SECONDS:
+            continue
+        if build_index(conn, table_name, positions[column_name], column_name, list(queries), db_path):
+            active += 1
+            built.append(column_name)
+    return built
+
+
+# Function to drop workload indexes whose columns the workload no longer uses
+def drop_idle_indexes(conn, idle_seconds=INDEX_IDLE_SECONDS):
+    rows = conn.execute(
+        "SELECT a.index_name, a.table_name, a.column_name FROM advisor_indexes a "
+        "WHERE a.reason = 'workload' AND a.status = 'active' AND COALESCE((SELECT MAX(w.last_used_at) FROM index_workload w "
+        "WHERE w.table_name = a.table_name AND w.column_name = a.column_name), 0) < ?",
+        (time.time() - idle_seconds,)).fetchall()
+    with conn:
+        for index_name, table_name, column_name in rows:
+            conn.execute(f"DROP INDEX IF EXISTS {quote_identifier(index_name)}")
+            conn.execute("UPDATE advisor_indexes SET status = 'dropped' WHERE index_name = ?", (index_name,))
+            # Start counting afresh, so a dropped index is rebuilt only if the workload returns
+            conn.execute("DELETE FROM index_workload WHERE table_name = ? AND column_name = ?", (table_name, column_name))
+    return [index_name for index_name, _, _ in rows]
+
+
+# Function to remove the advisor's bookkeeping for dropped tables; the caller owns the transaction
+def forget_tables(conn, tables):
+    for table_name in tables:
+        conn.execute("DELETE FROM index_workload WHERE table_name = ?", (table_name,))
+        conn.execute("DELETE FROM query_log WHERE table_name = ?", (table_name,))
+        conn.execute("DELETE FROM advisor_indexes WHERE table_name = ?", (table_name,))
+
+
+# Background thread that records executed queries and builds or drops indexes from the
+# workload, so index builds and benchmarks never hold up an answer
+class IndexAdvisor:
+    def __init__(self, db_path=DATABASE_PATH, max_queue=ADVISOR_QUEUE_SIZE):
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name="index-advisor", daemon=True)
+        self.thread.start()
+
+    # Advice is best effort: when the queue is full the query is simply not recorded
+    def submit(self, sql, tables, seconds, indexes=()):
+        try:
+            self.queue.put_nowait((sql, tuple(tables), seconds, tuple(indexes)))
+            return True
+        except queue.Full:
+            return False
+
+    # Block until every submitted query has been processed
+    def flush(self):
+        self.queue.join()
+
+    def close(self, timeout=10):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    break
+                conn = get_connection(self.db_path)
+                sql, tables, seconds, indexes = item
+                for table_name in record_workload(conn, sql, tables, seconds, indexes):
+                    advise_table(conn, table_name, self.db_path)
+                drop_idle_indexes(conn)
+            except sqlite3.Error as e:
+                print(f"An error occurred: {e}")
+            finally:
+                self.queue.task_done()
+        close_connections()
+
+
+_advisors = {}
+_advisors_lock = threading.Lock()
+
+
+def get_index_advisor(db_path=DATABASE_PATH):
+    with _advisors_lock:
+        advisor = _advisors.get(db_path)
+        if advisor is None:
+            advisor = _advisors[db_path] = IndexAdvisor(db_path)
+            atexit.register(advisor.close)
+        return advisor
+
+
+# Function to hand an executed query to the background index advisor
+def record_query(sql, tables, seconds, indexes=(), db_path=DATABASE_PATH):
+    return get_index_advisor(db_path).submit(sql, tables, seconds, indexes)
+
+
+# Function to list the advisor's indexes on a set of tables with their measured latency impact
+def get_index_report(tables, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    placeholders = ', '.join(['?'] * len(tables))
+    report = pd.read_sql(f"SELECT table_name, column_name, reason, status, before_seconds, after_seconds FROM advisor_indexes "
+                         f"WHERE table_name IN ({placeholders}) ORDER BY table_name, created_at", con=conn, params=tuple(tables))
+    report["speedup"] = report["before_seconds"] / report["after_seconds"]
+    return report
+
+
+# Function to describe the advisor indexes a query used, with the latency change measured when each was built
+def describe_index_use(index_names, db_path=DATABASE_PATH):
+    if not index_names:
+        return []
+    conn = get_connection(db_path)
+    placeholders = ', '.join(['?'] * len(index_names))
+    rows = conn.execute(f"SELECT column_name, reason, before_seconds, after_seconds FROM advisor_indexes "
+                        f"WHERE index_name IN ({placeholders}) AND status = 'active'", tuple(index_names)).fetchall()
+    descriptions = []
+    for column_name, reason, before, after in rows:
+        if reason == "key":
+            descriptions.append(f"Used the key index on `{column_name}` built at upload.")
+        else:
+            descriptions.append(f"Used the index on `{column_name}` built from your query history; "
+                                f"similar queries went from {before * 1000:,.0f} ms to {after * 1000:,.0f} ms.")
+    return descriptions
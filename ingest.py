@@ -0,0 +1,258 @@
+import time
+import pandas as pd
+from decimal import Decimal
+from db import get_connection, DATABASE_PATH
+from data_profile import TableProfile, save_profile
+
+# Rows per executemany batch during ingestion
+INSERT_BATCH_SIZE = 50000
+
+# Rows read from an uploaded file per chunk in streaming mode
+READ_CHUNK_ROWS = 100000
+
+# Rows kept in session state as a preview of an ingested file
+PREVIEW_ROWS = 5
+
+# Pragmas applied for the duration of a bulk load and restored afterwards
+LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "temp_store": "MEMORY",
+    "cache_size": "-200000",
+}
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+# Inferred pandas value kinds for object columns and the SQLite type they map to
+OBJECT_KIND_TYPES = {
+    "integer": "INTEGER",
+    "boolean": "INTEGER",
+    "floating": "REAL",
+    "mixed-integer-float": "REAL",
+    "decimal": "REAL",
+    "datetime": "DATE",
+    "datetime64": "DATE",
+    "date": "DATE",
+}
+
+# ISO formats used to store date columns so they sort and compare correctly as text
+DATE_FORMATS = {
+    "DATE": "%Y-%m-%d",
+    "TIMESTAMP": "%Y-%m-%d %H:%M:%S",
+}
+
+# read_csv leaves dates as text; a text column is a date column when nearly all its values are ISO dates
+ISO_DATE_PATTERN = r"\s*\d{4}-\d{1,2}-\d{1,2}"
+DATE_TEXT_MIN_RATIO = 0.95
+
+# Python types sqlite3 binds as they are
+BINDABLE_TYPES = (str, int, float)
+
+
+# Function to map a pandas column to a SQLite column type
+def infer_sqlite_type(series):
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return infer_date_type(series)
+    if dtype == object or pd.api.types.is_string_dtype(dtype):
+        kind = pd.api.types.infer_dtype(series, skipna=True)
+        col_type = OBJECT_KIND_TYPES.get(kind, "TEXT")
+        if col_type == "DATE" or (kind == "string" and is_date_text(series)):
+            return infer_date_type(series)
+        return col_type
+    return "TEXT"
+
+
+def parse_dates(series):
+    try:
+        return pd.to_datetime(series, format="ISO8601", errors="coerce")
+    except (ValueError, TypeError):
+        # e.g. mixed time zones, which pandas refuses to coerce; treat the values as not dates
+        return pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+
+
+# Function to check whether a text column holds ISO dates, allowing a few stray values such as "TBD"
+def is_date_text(series):
+    values = series.dropna()
+    if values.empty:
+        return False
+    if values.astype(str).str.match(ISO_DATE_PATTERN).mean() < DATE_TEXT_MIN_RATIO:
+        return False
+    return parse_dates(values).notna().mean() >= DATE_TEXT_MIN_RATIO
+
+
+# Dates without a time component are stored as DATE, everything else as TIMESTAMP
+def infer_date_type(series):
+    values = parse_dates(series).dropna()
+    return "TIMESTAMP" if (values.dt.normalize() != values).any() else "DATE"
+
+
+def infer_column_types(df):
+    return {col: infer_sqlite_type(df[col]) for col in df.columns}
+
+
+# Function to format a date column as ISO text. Types are inferred from the first chunk only, so a later
+# value with a time of day keeps it, and a value that does not parse as a date is stored as it was.
+def format_dates(series, col_type):
+    parsed = parse_dates(series)
+    formatted = parsed.dt.strftime(DATE_FORMATS[col_type])
+    if col_type == "DATE":
+        has_time = parsed.notna() & (parsed.dt.normalize() != parsed)
+        if has_time.any():
+            formatted = formatted.where(~has_time, parsed.dt.strftime(DATE_FORMATS["TIMESTAMP"]))
+    unparsed = parsed.isna() & series.notna()
+    if unparsed.any():
+        formatted = formatted.astype(object).where(~unparsed, series)
+    return formatted
+
+
+# Function to turn a DataFrame chunk into plain Python rows that sqlite3 can bind
+def prepare_rows(df, column_types):
+    df = df.copy()
+    for col, col_type in column_types.items():
+        if col_type in DATE_FORMATS:
+            df[col] = format_dates(df[col], col_type)
+    df = df.astype(object).where(df.notna(), None)
+    for col, col_type in column_types.items():
+        # sqlite3 cannot bind values such as times of day, Timedeltas or Decimals, so they are stored as text;
+        # in a REAL column a Decimal is stored as its float value
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind in ("string", "integer", "floating", "empty"):
+            continue
+        if col_type == "REAL":
+            df[col] = df[col].map(lambda value: float(value) if isinstance(value, Decimal) else value)
+        elif col_type != "INTEGER":
+            df[col] = df[col].map(lambda value: value if value is None or isinstance(value, BINDABLE_TYPES) else str(value))
+    return list(df.itertuples(index=False, name=None))
+
+
+def create_table(cursor, table_name, column_types):
+    cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)}")
+    columns = ', '.join(f'{quote_identifier(col)} {col_type}' for col, col_type in column_types.items())
+    cursor.execute(f"CREATE TABLE {quote_identifier(table_name)} ({columns})")
+
+
+def insert_rows(cursor, table_name, df, column_types, batch_size=INSERT_BATCH_SIZE):
+    placeholders = ', '.join(['?'] * len(column_types))
+    insert_query = f"INSERT INTO {quote_identifier(table_name)} VALUES ({placeholders})"
+    for start in range(0, len(df), batch_size):
+        rows = prepare_rows(df.iloc[start:start + batch_size], column_types)
+        cursor.executemany(insert_query, rows)
+    return len(df)
+
+
+def apply_load_pragmas(conn):
+    previous = {}
+    for pragma, value in LOAD_PRAGMAS.items():
+        previous[pragma] = conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return previous
+
+
+def restore_pragmas(conn, previous):
+    for pragma, value in previous.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+
+# Function to bulk load a stream of DataFrame chunks into a typed table inside a single transaction.
+# Column types are inferred from the first chunk; only one chunk is held in memory at a time.
+def ingest_chunks(chunks, db_path=DATABASE_PATH, table_name='my_table', batch_size=INSERT_BATCH_SIZE):
+    start = time.perf_counter()
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("The uploaded file contains no data")
+    column_types = infer_column_types(first)
+    preview = first.head(PREVIEW_ROWS).copy()
+    profile = TableProfile(column_types, DATE_FORMATS)
+
+    conn = get_connection(db_path)
+    previous = apply_load_pragmas(conn)
+    cursor = conn.cursor()
+    rows = 0
+    try:
+        cursor.execute("BEGIN")
+        create_table(cursor, table_name, column_types)
+        rows += insert_rows(cursor, table_name, first, column_types, batch_size)
+        profile.update(first)
+        del first
+        for chunk in chunks:
+            chunk.columns = list(column_types)
+            rows += insert_rows(cursor, table_name, chunk, column_types, batch_size)
+            profile.update(chunk)
+        column_profile = profile.finish()
+        save_profile(cursor, table_name, column_profile)
+        cursor.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        restore_pragmas(conn, previous)
+
+    elapsed = time.perf_counter() - start
+    return {
+        "table": table_name,
+        "rows": rows,
+        "columns": column_types,
+        "preview": preview,
+        "profile": column_profile,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed if elapsed > 0 else float(rows),
+    }
+
+
+def ingest_dataframe(df, db_path=DATABASE_PATH, table_name='my_table', batch_size=INSERT_BATCH_SIZE):
+    return ingest_chunks([df], db_path, table_name, batch_size)
+
+
+# Function to read a CSV upload in fixed-size chunks
+def read_csv_chunks(file, chunksize=READ_CHUNK_ROWS):
+    yield from pd.read_csv(file, chunksize=chunksize)
+
+
+# A sheet with a header but no data rows still yields one empty chunk, so it loads as an empty table like a header-only CSV
+def frame_chunks(rows, columns, chunksize):
+    batch = []
+    empty = True
+    for row in rows:
+        batch.append(row[:len(columns)])
+        if len(batch) >= chunksize:
+            yield pd.DataFrame.from_records(batch, columns=columns)
+            batch = []
+            empty = False
+    if batch or empty:
+        yield pd.DataFrame.from_records(batch, columns=columns)
+
+
+# Function to read every non-empty sheet of an xlsx upload through openpyxl's read-only row iterator
+def read_xlsx_sheets(file, chunksize=READ_CHUNK_ROWS):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            columns = [str(col) if col is not None else f"column_{i}" for i, col in enumerate(header)]
+            yield worksheet.title, frame_chunks(rows, columns, chunksize)
+    finally:
+        workbook.close()
+
+
+# Function to yield (sheet name, chunk iterator) pairs for every table in an upload
+def read_file_tables(file, chunksize=READ_CHUNK_ROWS):
+    if file.name.endswith('csv'):
+        yield None, read_csv_chunks(file, chunksize)
+    elif file.name.endswith('xlsx'):
+        yield from read_xlsx_sheets(file, chunksize)
+    else:
+        raise ValueError(f"Unsupported file type: {file.name}")
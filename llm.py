@@ -0,0 +1,56 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Model settings shared by SQL generation and answer summaries
+DEFAULT_MODEL = "claude-3-5-sonnet-20240620"
+DEFAULT_MAX_TOKENS = 8192
+# Number of distinct clients (API key and settings combinations) kept per process
+LLM_CLIENT_CACHE_SIZE = 16
+# Upper bound on LLM requests in flight across the process, whatever their entry point
+LLM_CONCURRENCY = int(os.environ.get("DATADIALOGUE_LLM_CONCURRENCY", "8"))
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+# Builds chat models in place of ChatAnthropic when set, e.g. the offline stand-in in fake_llm.py
+_model_factory = None
+_llm_slots = threading.BoundedSemaphore(LLM_CONCURRENCY)
+
+
+# Function to get the process-wide chat model for an API key and settings. Clients are built on
+# first use and then shared, so every question reuses the same HTTP connection pool.
+# langchain_anthropic is only imported here, which keeps it off the app's startup path.
+def get_chat_model(api_key=None, model=DEFAULT_MODEL, temperature=0, max_tokens=DEFAULT_MAX_TOKENS, top_p=0):
+    api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
+    key = (api_key, model, temperature, max_tokens, top_p)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        if _model_factory is not None:
+            factory = _model_factory
+        else:
+            from langchain_anthropic import ChatAnthropic as factory
+        settings = {"api_key": api_key} if api_key else {}
+        client = factory(model=model, temperature=temperature, max_tokens=max_tokens, top_p=top_p, **settings)
+        _clients[key] = client
+        while len(_clients) > LLM_CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+        return client
+
+
+# Function to make every chat model come from factory (None restores ChatAnthropic); drops cached clients
+def set_chat_model_factory(factory):
+    global _model_factory
+    with _clients_lock:
+        _model_factory = factory
+        _clients.clear()
+
+
+# Context manager to hold one of the process-wide LLM request slots, waiting for a free one
+@contextmanager
+def llm_slot():
+    with _llm_slots:
+        yield
@@ -0,0 +1,210 @@
+import os
+import time
+import uuid
+import atexit
+import sqlite3
+import hashlib
+import threading
+import contextvars
+import http.server
+import pandas as pd
+from contextlib import contextmanager
+from db import get_connection, DATABASE_PATH
+from result_cache import canonicalize_sql
+
+# Spans are buffered and written in one transaction once this many are pending or the oldest is this old
+SPAN_FLUSH_SIZE = 50
+SPAN_FLUSH_SECONDS = 5
+# The metrics table keeps at most this many spans
+METRICS_MAX_SPANS = int(os.environ.get("DATADIALOGUE_METRICS_MAX_SPANS", "100000"))
+# Latency histogram buckets, in seconds, for the Prometheus output
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_turn = contextvars.ContextVar("turn_id", default=None)
+_pending = []
+_pending_since = None
+_pending_lock = threading.Lock()
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+# One timed stage of a turn. Stages fill in what they know: tokens, rows, cache hits and the SQL hash.
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.turn_id = _current_turn.get()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.rows = None
+        self.cache_hit = None
+        self.sql_hash = None
+        self.error = None
+
+    # Add the token usage reported on an LLM response or streamed chunk
+    def add_usage(self, message):
+        usage = getattr(message, "usage_metadata", None) or {}
+        self.input_tokens += usage.get("input_tokens") or 0
+        self.output_tokens += usage.get("output_tokens") or 0
+
+    def set_sql(self, sql):
+        self.sql_hash = hashlib.sha256(canonicalize_sql(sql).encode()).hexdigest()[:16]
+
+    def as_row(self):
+        return (self.turn_id, self.stage, self.started_at, self.seconds, self.input_tokens, self.output_tokens, self.rows,
+                None if self.cache_hit is None else int(self.cache_hit), self.sql_hash, self.error)
+
+
+# Context manager to tie the spans recorded inside it to one turn (one question and its answer)
+@contextmanager
+def trace_turn(turn_id=None):
+    token = _current_turn.set(turn_id or uuid.uuid4().hex)
+    try:
+        yield _current_turn.get()
+    finally:
+        _current_turn.reset(token)
+
+
+# Context manager to time a stage; the span is recorded when the block exits, also on errors
+@contextmanager
+def span(stage):
+    current = Span(stage)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.seconds = time.perf_counter() - current.started
+        record_span(current)
+
+
+def record_span(current, db_path=DATABASE_PATH):
+    global _pending_since
+    with _totals_lock:
+        totals = _totals.setdefault(current.stage, {
+            "count": 0, "seconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS), "input_tokens": 0, "output_tokens": 0,
+            "rows": 0, "cache_hits": 0, "cache_misses": 0, "errors": 0})
+        totals["count"] += 1
+        totals["seconds"] += current.seconds
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if current.seconds <= bound:
+                totals["buckets"][index] += 1
+        totals["input_tokens"] += current.input_tokens
+        totals["output_tokens"] += current.output_tokens
+        totals["rows"] += current.rows or 0
+        if current.cache_hit is not None:
+            totals["cache_hits" if current.cache_hit else "cache_misses"] += 1
+        if current.error is not None:
+            totals["errors"] += 1
+    with _pending_lock:
+        _pending.append(current.as_row())
+        _pending_since = _pending_since or time.monotonic()
+        due = len(_pending) >= SPAN_FLUSH_SIZE or time.monotonic() - _pending_since >= SPAN_FLUSH_SECONDS
+    if due:
+        flush_spans(db_path)
+
+
+# Function to write buffered spans to the metrics table in one transaction
+def flush_spans(db_path=DATABASE_PATH):
+    global _pending_since
+    with _pending_lock:
+        rows = _pending[:]
+        _pending.clear()
+        _pending_since = None
+    if not rows:
+        return
+    conn = get_connection(db_path)
+    try:
+        with conn:
+            conn.executemany("INSERT INTO metrics_spans (turn_id, stage, started_at, seconds, input_tokens, output_tokens, "
+                             "rows, cache_hit, sql_hash, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("DELETE FROM metrics_spans WHERE id <= (SELECT MAX(id) FROM metrics_spans) - ?", (METRICS_MAX_SPANS,))
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+
+
+atexit.register(flush_spans)
+
+
+# Function to get per-stage latency percentiles, token use and cache hit rate over a recent window
+def get_stage_summary(since_seconds=24 * 3600, db_path=DATABASE_PATH):
+    flush_spans(db_path)
+    spans = pd.read_sql("SELECT stage, seconds, input_tokens, output_tokens, rows, cache_hit FROM metrics_spans "
+                        "WHERE started_at >= ?", con=get_connection(db_path), params=(time.time() - since_seconds,))
+    if spans.empty:
+        return pd.DataFrame(columns=["stage", "count", "p50_ms", "p95_ms", "avg_input_tokens", "avg_output_tokens", "cache_hit_rate"])
+    grouped = spans.groupby("stage", sort=False)
+    summary = pd.DataFrame({
+        "count": grouped["seconds"].count(),
+        "p50_ms": grouped["seconds"].quantile(0.5) * 1000,
+        "p95_ms": grouped["seconds"].quantile(0.95) * 1000,
+        "avg_input_tokens": grouped["input_tokens"].mean(),
+        "avg_output_tokens": grouped["output_tokens"].mean(),
+        "cache_hit_rate": grouped["cache_hit"].mean(),
+    })
+    return summary.reset_index()
+
+
+def format_labels(labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+# Function to render this process's stage metrics in the Prometheus text exposition format
+def render_prometheus():
+    with _totals_lock:
+        totals = {stage: dict(values, buckets=list(values["buckets"])) for stage, values in _totals.items()}
+    lines = [
+        "# HELP datadialogue_stage_seconds Wall time of each pipeline stage.",
+        "# TYPE datadialogue_stage_seconds histogram",
+    ]
+    for stage, values in totals.items():
+        for bound, count in zip(LATENCY_BUCKETS, values["buckets"]):
+            lines.append(f"datadialogue_stage_seconds_bucket{format_labels({'stage': stage, 'le': bound})} {count}")
+        lines.append(f"datadialogue_stage_seconds_bucket{format_labels({'stage': stage, 'le': '+Inf'})} {values['count']}")
+        lines.append(f"datadialogue_stage_seconds_sum{format_labels({'stage': stage})} {values['seconds']}")
+        lines.append(f"datadialogue_stage_seconds_count{format_labels({'stage': stage})} {values['count']}")
+    counters = [
+        ("datadialogue_llm_tokens_total", "LLM tokens used per stage.",
+         lambda values: [({"direction": "input"}, values["input_tokens"]), ({"direction": "output"}, values["output_tokens"])]),
+        ("datadialogue_rows_total", "Result rows returned per stage.", lambda values: [({}, values["rows"])]),
+        ("datadialogue_cache_lookups_total", "Cache lookups per stage.",
+         lambda values: [({"result": "hit"}, values["cache_hits"]), ({"result": "miss"}, values["cache_misses"])]),
+        ("datadialogue_stage_errors_total", "Stages that ended with an error.", lambda values: [({}, values["errors"])]),
+    ]
+    for name, description, samples in counters:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for stage, values in totals.items():
+            for labels, value in samples(values):
+                lines.append(f"{name}{format_labels({'stage': stage, **labels})} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_prometheus().encode()
+        self.send_response(200 if self.path == "/metrics" else 404)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+# Function to serve /metrics for scraping from a background thread; starts at most once per process
+def start_metrics_server(port, host="127.0.0.1"):
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            _metrics_server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _metrics_server
@@ -0,0 +1,214 @@
+import asyncio
+import sqlite3
+import contextvars
+import pandas as pd
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from db import DATABASE_PATH
+from llm import get_chat_model, llm_slot
+from sql_cache import lookup_sql, store_sql, forget_sql
+from schema_context import get_schema_context, schema_prompt_for_question
+from query_governor import run_governed_query
+from index_advisor import record_query
+from result_cache import get_cached_result, cache_result
+from result_encoding import encode_result_for_prompt
+from datasets import get_dataset_version
+from sampling import sample_query_for, SAMPLE_QUERY_TIMEOUT_SECONDS
+from metrics import span
+
+# Blocking stages (LLM calls, SQLite) run on this shared pool. Its threads outlive each
+# question, so their pooled SQLite connections are reused rather than reopened.
+PIPELINE_WORKERS = 8
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+# Function to run a blocking stage on the pipeline pool without blocking the event loop.
+# The stage is called as func(report); every value it reports is passed to on_update on the
+# event loop's thread, so on_update may draw UI. Once cancel_event is set, the next report
+# raises PipelineCancelled inside the stage. Leaving before the stage has finished, for any
+# reason, sets cancel_event; a stage that fails on its own leaves it alone.
+async def run_stage(func, cancel_event, on_update=None):
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+
+    def report(value):
+        if cancel_event.is_set():
+            raise PipelineCancelled()
+        loop.call_soon_threadsafe(updates.put_nowait, value)
+
+    # Run in a copy of the caller's context so spans recorded by the stage join the current turn
+    stage = loop.run_in_executor(_executor, contextvars.copy_context().run, func, report)
+    try:
+        while True:
+            update = asyncio.ensure_future(updates.get())
+            await asyncio.wait({stage, update}, return_when=asyncio.FIRST_COMPLETED)
+            if update.done():
+                if on_update is not None:
+                    on_update(update.result())
+                continue
+            update.cancel()
+            while not updates.empty():
+                value = updates.get_nowait()
+                if on_update is not None:
+                    on_update(value)
+            return stage.result()
+    except BaseException:
+        if not stage.done():
+            cancel_event.set()
+        raise
+
+
+# Function to run plain blocking calls side by side on the pipeline pool
+async def run_concurrently(*calls):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(_executor, contextvars.copy_context().run, call) for call in calls))
+
+
+# Function to get the text of a streamed message chunk, whether its content is a string or content blocks
+def chunk_text(chunk) -> str:
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") if isinstance(block, dict) else str(block) for block in content)
+
+
+# Function to stream the summary token by token as the model produces it
+def stream_answer_in_text_form(user_question: str, answer: pd.DataFrame, sql_query: str) -> Iterator[str]:
+    if isinstance(answer, pd.DataFrame):
+        answer_data = encode_result_for_prompt(answer)
+        answer_format = f'''Summarize the answer to the question: "{user_question}" using the provided result data:
+"""
+{answer_data}
+"""
+and the SQL query used to obtain this data: "{sql_query}".
+
+                            1. Analyze the SQL query to understand:
+                            - The tables and columns being queried
+                            - Any joins, aggregations, or transformations applied
+                            - The meaning and context of each column in the result set
+
+                            2. Based on this analysis, interpret the result data, understanding what each field represents. For large results the data is given as row counts, per-column statistics and sample rows rather than every row.
+
+                            3. Summarize the answer for a business executive audience:
+                            - Use bullet points for clarity
+                            - Highlight key numbers using bold formatting (e.g., **1000**)
+                            - Use tables only when necessary for clarity
+                            - Focus on directly answering the question without extra recommendations or reasoning
+                            - Keep the summary concise and to the point
+
+                            4. Formatting guidelines:
+                            - Start directly with the answer, without mentioning the audience or using phrases like "Here is a summary..."
+                            - Use a single blank line between bullet points
+                            - Replace any '$' with "\$" in the final text
+                            - Present the information as a natural, conversational response without referencing the data source
+
+                            Aim for a clear, concise summary that directly addresses the question based on the provided data and query analysis.'''
+        with span("summarize") as summary_span, llm_slot():
+            summary_span.rows = len(answer)
+            summary_span.set_sql(sql_query)
+            for chunk in get_chat_model().stream(answer_format):
+                summary_span.add_usage(chunk)
+                yield chunk_text(chunk)
+        return
+    yield "No answer could be generated."  # Default return if conditions are not met
+
+
+def format_answer_in_text_form(user_question: str, answer: pd.DataFrame, sql_query: str) -> str:
+    return "".join(stream_answer_in_text_form(user_question, answer, sql_query))
+
+
+# Function to run a query through the result cache and the query governor; errors are raised
+def run_query(query, tables=None, cancel_event=None):
+    with span("execute_query") as query_span:
+        query_span.set_sql(query)
+        dataset_version = get_dataset_version(tables) if tables else None
+        if dataset_version:
+            cached_df = get_cached_result(query, dataset_version)
+            query_span.cache_hit = cached_df is not None
+            if cached_df is not None:
+                query_span.rows = len(cached_df)
+                return cached_df
+
+        # Runs under a timeout and row cap; a plan check rejects runaway full-scan joins
+        try:
+            result_df = run_governed_query(query, DATABASE_PATH, cancel_event=cancel_event)
+        except sqlite3.Error:
+            # Errors and governor rejections mean the SQL itself is at fault; a cancelled query is not
+            if cancel_event is None or not cancel_event.is_set():
+                forget_sql(query)
+            raise
+        query_span.rows = len(result_df)
+        # A partial result, e.g. one cut short by the timeout, is not kept; asking again runs the query again
+        if dataset_version and not result_df.attrs["truncated"]:
+            cache_result(query, dataset_version, result_df)
+        if tables:
+            # The advisor learns which columns to index from the queries that actually run
+            record_query(query, tables, result_df.attrs["seconds"], result_df.attrs["indexes"])
+        return result_df
+
+
+# Function to run a query against the sample of the large table it reads, for a quick approximate answer.
+# Counts and sums are scaled up to estimate the full table. Returns None when no sample applies.
+def run_sample_query(query, tables, cancel_event=None):
+    sample_query, fraction = sample_query_for(query, tables) if tables else (None, None)
+    if sample_query is None:
+        return None
+    with span("execute_sample_query") as query_span:
+        query_span.set_sql(query)
+        result_df = run_governed_query(sample_query, DATABASE_PATH, timeout_seconds=SAMPLE_QUERY_TIMEOUT_SECONDS,
+                                       cancel_event=cancel_event)
+        query_span.rows = len(result_df)
+    result_df.attrs["approximate"] = True
+    result_df.attrs["sample_fraction"] = fraction
+    return result_df
+
+
+# Function to generate SQL query using ChatBedrock.
+# If on_token is given, the query is streamed and on_token is called with the text generated so far.
+def generate_sql_query(user_question, tables, on_token=None):
+    with span("generate_sql") as sql_span:
+        # Get the precomputed schema information
+        schema_context = get_schema_context(tables)
+        schema_hash = schema_context["schema_hash"]
+
+        # Reuse SQL generated earlier for the same question against the same schema
+        cached_sql = lookup_sql(user_question, schema_hash)
+        sql_span.cache_hit = cached_sql is not None
+        if cached_sql is not None:
+            sql_span.set_sql(cached_sql)
+            return cached_sql
+
+        model = get_chat_model()
+
+        # Only send the columns of wide tables that the question is likely to reference
+        schema_info = schema_prompt_for_question(schema_context, user_question)
+
+        prompt = f"""Given the following schema for the available tables:
+
+{schema_info}
+
+Generate a SQL query to answer the following question:
+
+{user_question}
+
+Return only the SQL query without any explanations."""
+
+        with llm_slot():
+            if on_token is None:
+                response = model.invoke(prompt)
+                sql_span.add_usage(response)
+                sql_query = chunk_text(response)
+            else:
+                sql_query = ""
+                for chunk in model.stream(prompt):
+                    sql_span.add_usage(chunk)
+                    sql_query += chunk_text(chunk)
+                    on_token(sql_query)
+        sql_span.set_sql(sql_query)
+        store_sql(user_question, schema_hash, tables, sql_query)
+        return sql_query
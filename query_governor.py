@@ -0,0 +1,134 @@
+import os
+import re
+import time
+import sqlite3
+import pandas as pd
+from db import get_connection, DATABASE_PATH
+
+# Limits applied to every generated query
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("DATADIALOGUE_QUERY_TIMEOUT_SECONDS", "30"))
+MAX_RESULT_ROWS = int(os.environ.get("DATADIALOGUE_MAX_RESULT_ROWS", "100000"))
+FETCH_CHUNK_ROWS = 10000
+# Full-scan joins whose estimated row product exceeds this are rejected before running
+MAX_CROSS_JOIN_ROWS = int(os.environ.get("DATADIALOGUE_MAX_CROSS_JOIN_ROWS", str(10 ** 8)))
+# SQLite virtual machine instructions between deadline checks
+PROGRESS_HANDLER_STEPS = 10000
+
+SCAN_PATTERN = re.compile(r"^SCAN (\S+)")
+INDEX_PATTERN = re.compile(r"USING (?:COVERING )?INDEX (\S+)")
+# Table references with an optional alias, e.g. `FROM sales s` or `JOIN "sales" AS s2`
+TABLE_REFERENCE_PATTERN = re.compile(r'(?:\bFROM|\bJOIN|,)\s+"?(\w+)"?(?:\s+(?:AS\s+)?"?(\w+)"?)?', re.IGNORECASE)
+NOT_ALIASES = {"where", "on", "using", "join", "inner", "left", "right", "full", "cross", "natural", "group",
+               "order", "limit", "having", "union", "except", "intersect", "window", "as"}
+
+
+class QueryRejectedError(sqlite3.DatabaseError):
+    pass
+
+
+# Function to map the names shown in a query plan (aliases included) to table names
+def table_aliases(sql):
+    aliases = {}
+    for table_name, alias in TABLE_REFERENCE_PATTERN.findall(sql):
+        aliases[table_name] = table_name
+        if alias and alias.lower() not in NOT_ALIASES:
+            aliases[alias] = table_name
+    return aliases
+
+
+def table_row_count(conn, table_name):
+    row = conn.execute("SELECT row_count FROM datasets WHERE table_name = ?", (table_name,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def explain_query_plan(conn, sql):
+    return conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+
+
+# Function to list the indexes a query plan searches through
+def plan_indexes(plan):
+    return sorted({match.group(1) for *_, detail in plan for match in [INDEX_PATTERN.search(detail)] if match})
+
+
+# Function to inspect the query plan for nested full scans, i.e. joins with no usable index.
+# Returns warnings for small ones and raises QueryRejectedError for ones that would explode.
+def check_query_plan(conn, sql, plan, max_cross_join_rows=MAX_CROSS_JOIN_ROWS):
+    scans_by_parent = {}
+    for _, parent, _, detail in plan:
+        match = SCAN_PATTERN.match(detail)
+        if match:
+            scans_by_parent.setdefault(parent, []).append(match.group(1))
+
+    aliases = table_aliases(sql)
+    warnings = []
+    for tables in scans_by_parent.values():
+        if len(tables) < 2:
+            continue
+        counts = [table_row_count(conn, aliases.get(name, name)) for name in tables]
+        estimate = 1
+        for count in counts:
+            # CTEs and subqueries have no registered size; the estimate then is a lower bound
+            estimate *= count if count is not None else 1
+        joined = " × ".join(tables)
+        if estimate > max_cross_join_rows:
+            raise QueryRejectedError(
+                f"Query rejected: it joins {joined} by full scans without a usable join condition "
+                f"(about {estimate:,} row combinations).")
+        warnings.append(f"The query joins {joined} by full scans; it may be slow on larger data.")
+    return warnings
+
+
+# Function to run a query with a wall-clock timeout and a row cap, fetching through a cursor
+# in chunks. The returned frame carries "truncated", "truncation_reason", "warnings", the indexes
+# the plan used and the elapsed "seconds" in attrs. Setting cancel_event interrupts the query.
+def run_governed_query(sql, db_path=DATABASE_PATH, timeout_seconds=QUERY_TIMEOUT_SECONDS,
+                       max_rows=MAX_RESULT_ROWS, chunk_rows=FETCH_CHUNK_ROWS, cancel_event=None):
+    conn = get_connection(db_path)
+    plan = explain_query_plan(conn, sql)
+    warnings = check_query_plan(conn, sql, plan)
+
+    started = time.monotonic()
+    deadline = started + timeout_seconds
+    cancelled = cancel_event.is_set if cancel_event is not None else lambda: False
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline or cancelled() else 0, PROGRESS_HANDLER_STEPS)
+    rows = []
+    truncation_reason = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+        columns = [column[0] for column in cursor.description or []]
+        while len(rows) <= max_rows:
+            try:
+                chunk = cursor.fetchmany(min(chunk_rows, max_rows + 1 - len(rows)))
+            except sqlite3.OperationalError as e:
+                # Keep what was fetched before the deadline; fail only if nothing came back
+                if "interrupted" not in str(e) or not rows or cancelled():
+                    raise
+                truncation_reason = f"timed out after {timeout_seconds:g}s"
+                break
+            if not chunk:
+                break
+            rows.extend(chunk)
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e) and cancelled():
+            raise QueryRejectedError("Query cancelled") from e
+        if "interrupted" in str(e):
+            raise QueryRejectedError(f"Query timed out after {timeout_seconds:g}s") from e
+        raise
+    finally:
+        cursor.close()
+        conn.set_progress_handler(None, 0)
+        if conn.in_transaction:
+            conn.rollback()
+
+    if len(rows) > max_rows:
+        rows = rows[:max_rows]
+        truncation_reason = f"limited to the first {max_rows:,} rows"
+
+    result_df = pd.DataFrame.from_records(rows, columns=columns)
+    result_df.attrs["truncated"] = truncation_reason is not None
+    result_df.attrs["truncation_reason"] = truncation_reason
+    result_df.attrs["warnings"] = warnings
+    result_df.attrs["indexes"] = plan_indexes(plan)
+    result_df.attrs["seconds"] = time.monotonic() - started
+    return result_df
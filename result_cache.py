@@ -0,0 +1,177 @@
+import os
+import re
+import uuid
+import atexit
+import hashlib
+import threading
+import pandas as pd
+from collections import OrderedDict
+
+# In-memory budget for cached result frames
+RESULT_CACHE_MEMORY_MB = int(os.environ.get("DATADIALOGUE_RESULT_CACHE_MEMORY_MB", "256"))
+# Frames larger than this are written to disk as Parquet instead of being kept in memory
+RESULT_SPILL_THRESHOLD_MB = int(os.environ.get("DATADIALOGUE_RESULT_SPILL_THRESHOLD_MB", "16"))
+RESULT_SPILL_BUDGET_MB = int(os.environ.get("DATADIALOGUE_RESULT_SPILL_BUDGET_MB", "2048"))
+RESULT_CACHE_DIR = os.environ.get("DATADIALOGUE_RESULT_CACHE_DIR", "result_cache")
+
+# Quoted strings and identifiers are kept verbatim when canonicalizing SQL
+SQL_LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\])")
+
+
+# Function to canonicalize SQL so formatting differences map to the same cache entry
+def canonicalize_sql(sql):
+    sql = re.sub(r"^\s*```(?:sql)?|```\s*$", "", str(sql).strip(), flags=re.IGNORECASE)
+    parts = SQL_LITERAL_PATTERN.split(sql)
+    canonical = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            canonical.append(part)
+            continue
+        part = re.sub(r"--[^\n]*|/\*.*?\*/", " ", part, flags=re.DOTALL)
+        part = re.sub(r"\s+", " ", part).lower()
+        part = re.sub(r"\s*([(),=<>+*/-])\s*", r"\1", part)
+        canonical.append(part)
+    return "".join(canonical).strip().rstrip(";").strip()
+
+
+def result_key(sql, dataset_version):
+    return hashlib.sha256(f"{dataset_version}\x1e{canonicalize_sql(sql)}".encode()).hexdigest()
+
+
+def frame_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+# LRU cache of query results. Small frames stay in memory under a byte budget;
+# large frames are spilled to a Parquet file and read back on a hit.
+class ResultCache:
+    def __init__(self, memory_mb=RESULT_CACHE_MEMORY_MB, spill_threshold_mb=RESULT_SPILL_THRESHOLD_MB,
+                 spill_budget_mb=RESULT_SPILL_BUDGET_MB, cache_dir=RESULT_CACHE_DIR):
+        self.memory_budget = memory_mb * 1024 * 1024
+        self.spill_threshold = spill_threshold_mb * 1024 * 1024
+        self.spill_budget = spill_budget_mb * 1024 * 1024
+        self.cache_dir = cache_dir
+        self.memory = OrderedDict()
+        self.spilled = OrderedDict()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "spills": 0}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.memory[key][0].copy()
+            path = self.spilled.get(key, (None, 0))[0]
+            if path is not None:
+                self.spilled.move_to_end(key)
+        if path is not None:
+            try:
+                df = read_spilled(path)
+            except (OSError, ValueError):
+                with self.lock:
+                    self.drop_spilled(key)
+            else:
+                with self.lock:
+                    self.stats["hits"] += 1
+                return df
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, df):
+        size = frame_size(df)
+        if size > self.spill_threshold:
+            self.spill(key, df)
+            return
+        if size > self.memory_budget:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= self.memory.pop(key)[1]
+            self.memory[key] = (df.copy(), size)
+            self.memory_bytes += size
+            while self.memory_bytes > self.memory_budget:
+                _, (_, evicted_size) = self.memory.popitem(last=False)
+                self.memory_bytes -= evicted_size
+
+    def spill(self, key, df):
+        try:
+            # Parquet support is optional; without it large results are simply not cached
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, f"{os.getpid()}-{uuid.uuid4().hex}.parquet")
+        try:
+            write_spilled(df, path)
+        except (ValueError, TypeError, OSError):
+            # Frames Parquet cannot represent (e.g. duplicate column names) are simply not cached
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        size = os.path.getsize(path)
+        with self.lock:
+            self.drop_spilled(key)
+            self.spilled[key] = (path, size)
+            self.spilled_bytes += size
+            self.stats["spills"] += 1
+            while self.spilled_bytes > self.spill_budget and len(self.spilled) > 1:
+                self.drop_spilled(next(iter(self.spilled)))
+
+    # Caller must hold the lock
+    def drop_spilled(self, key):
+        path, size = self.spilled.pop(key, (None, 0))
+        if path is not None:
+            self.spilled_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            for key in list(self.spilled):
+                self.drop_spilled(key)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, memory_entries=len(self.memory), memory_bytes=self.memory_bytes,
+                        spilled_entries=len(self.spilled), spilled_bytes=self.spilled_bytes)
+
+
+def write_spilled(df, path):
+    # Parquet needs string column names
+    df = df.copy()
+    df.columns = [str(col) for col in df.columns]
+    df.to_parquet(path, index=False, compression="zstd")
+
+
+def read_spilled(path):
+    return pd.read_parquet(path)
+
+
+_cache = ResultCache()
+# The spill index lives in memory, so spilled files are removed when the process exits
+atexit.register(_cache.clear)
+
+
+# Function to get a cached query result for the given dataset version, or None on a miss
+def get_cached_result(sql, dataset_version):
+    return _cache.get(result_key(sql, dataset_version))
+
+
+def cache_result(sql, dataset_version, df):
+    _cache.put(result_key(sql, dataset_version), df)
+
+
+def clear_result_cache():
+    _cache.clear()
+
+
+def get_result_cache_stats():
+    return _cache.get_stats()
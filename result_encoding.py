@@ -0,0 +1,76 @@
+import pandas as pd
+
+# Approximate token budget for the result data embedded in the summarization prompt
+RESULT_PROMPT_TOKEN_BUDGET = 3000
+# Rough characters per token, used to turn the token budget into a character budget
+CHARS_PER_TOKEN = 4
+
+# Settings for the aggregate encoding used when the rows themselves do not fit
+TOP_K_VALUES = 5
+SAMPLE_ROWS = 5
+MAX_CELL_CHARS = 60
+
+
+# Columns are read by position throughout: a self-join can return two columns with the same name,
+# and df[name] would then be a frame rather than a column
+def truncate_cells(df, max_chars=MAX_CELL_CHARS):
+    if df.columns.empty:
+        return df.copy()
+    columns = []
+    for position in range(len(df.columns)):
+        values = df.iloc[:, position]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = values.astype(str)
+            values = values.where(values.str.len() <= max_chars, values.str.slice(0, max_chars - 1) + "…")
+        columns.append(values)
+    return pd.concat(columns, axis=1)
+
+
+def to_csv_text(df):
+    return truncate_cells(df).to_csv(index=False, float_format="%.6g").strip()
+
+
+# Function to describe a large result with vectorized aggregates instead of its rows
+def encode_aggregates(df, max_chars):
+    lines = [f"Result has {len(df):,} rows and {len(df.columns)} columns. Summary statistics per column:"]
+
+    numeric = df.select_dtypes(include="number")
+    if not numeric.empty:
+        stats = numeric.agg(["count", "min", "max", "mean", "sum"]).T
+        stats.insert(0, "nulls", len(df) - stats["count"])
+        stats = stats.drop(columns="count")
+        stats.index.name = "column"
+        lines.append("Numeric columns:")
+        lines.append(stats.to_csv(float_format="%.10g").strip())
+
+    for position in range(len(df.columns)):
+        values = df.iloc[:, position]
+        if pd.api.types.is_numeric_dtype(values):
+            continue
+        counts = values.astype(str).value_counts(dropna=False)
+        top = ", ".join(f"{str(value)[:MAX_CELL_CHARS]} ({count:,})" for value, count in counts.head(TOP_K_VALUES).items())
+        lines.append(f"{values.name}: {values.nunique(dropna=True):,} distinct, {int(values.isna().sum()):,} nulls; top values: {top}")
+
+    lines.append(f"First {SAMPLE_ROWS} rows:")
+    lines.append(to_csv_text(df.head(SAMPLE_ROWS)))
+    lines.append(f"Last {SAMPLE_ROWS} rows:")
+    lines.append(to_csv_text(df.tail(SAMPLE_ROWS)))
+
+    text = "\n".join(lines)
+    if len(text) > max_chars:
+        text = text[:max_chars] + "\n[truncated]"
+    return text
+
+
+# Function to encode a query result for the summarization prompt within a fixed token budget.
+# Results that fit are sent as CSV rows; larger ones as per-column aggregates plus head/tail samples.
+def encode_result_for_prompt(df, token_budget=RESULT_PROMPT_TOKEN_BUDGET):
+    max_chars = token_budget * CHARS_PER_TOKEN
+    if df.empty:
+        return f"The result has no rows. Columns: {', '.join(map(str, df.columns))}"
+    # Cheap upper bound check before rendering the whole frame as CSV
+    if len(df) * len(df.columns) <= max_chars:
+        csv_text = to_csv_text(df)
+        if len(csv_text) <= max_chars:
+            return f"Result has {len(df):,} rows (CSV):\n{csv_text}"
+    return encode_aggregates(df, max_chars)
@@ -0,0 +1,139 @@
+import os
+import uuid
+import shutil
+import weakref
+import threading
+import pandas as pd
+from collections import OrderedDict
+from result_cache import frame_size
+
+# Per-session budgets: recent result frames stay in memory up to SESSION_RESULT_MEMORY_MB, every
+# result is also kept on disk as Parquet, and the oldest results are removed beyond SESSION_RESULT_DISK_MB
+SESSION_RESULT_MEMORY_MB = int(os.environ.get("DATADIALOGUE_SESSION_RESULT_MEMORY_MB", "64"))
+SESSION_RESULT_DISK_MB = int(os.environ.get("DATADIALOGUE_SESSION_RESULT_DISK_MB", "512"))
+SESSION_RESULT_DIR = os.environ.get("DATADIALOGUE_SESSION_RESULT_DIR", "session_results")
+# Rows shown per page, and rows per Parquet row group so a page reads only the groups it needs
+RESULT_PAGE_ROWS = 100
+STORE_ROW_GROUP_ROWS = 10000
+
+
+# Per-session store of query results. The chat history keeps only the small handle returned by
+# put(); pages are read back from memory or from the session's Parquet files when rendered.
+class SessionResultStore:
+    def __init__(self, base_dir=SESSION_RESULT_DIR, memory_mb=SESSION_RESULT_MEMORY_MB, disk_mb=SESSION_RESULT_DISK_MB):
+        self.directory = os.path.join(base_dir, f"{os.getpid()}-{uuid.uuid4().hex}")
+        self.memory_budget = memory_mb * 1024 * 1024
+        self.disk_budget = disk_mb * 1024 * 1024
+        self.memory = OrderedDict()
+        self.files = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        # Remove the session's files once the session state holding the store is released
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    def put(self, df):
+        result_id = uuid.uuid4().hex
+        handle = {"result_id": result_id, "rows": len(df), "columns": [str(col) for col in df.columns]}
+        path = self.spill(result_id, df)
+        with self.lock:
+            if path is not None:
+                size = os.path.getsize(path)
+                self.files[result_id] = (path, size)
+                self.disk_bytes += size
+                while self.disk_bytes > self.disk_budget and len(self.files) > 1:
+                    self.drop_file(next(iter(self.files)))
+            self.remember(result_id, df)
+        return handle
+
+    def spill(self, result_id, df):
+        try:
+            # Parquet support is optional; without it results live in memory only, under the memory budget
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{result_id}.parquet")
+        df = df.copy(deep=False)
+        df.columns = [str(col) for col in df.columns]
+        try:
+            df.to_parquet(path, index=False, compression="zstd", row_group_size=STORE_ROW_GROUP_ROWS)
+        except (ValueError, TypeError, OSError):
+            # Frames Parquet cannot represent (e.g. duplicate column names) are kept in memory only
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        return path
+
+    # Caller must hold the lock
+    def remember(self, result_id, df):
+        size = frame_size(df)
+        if size > self.memory_budget:
+            return
+        self.memory[result_id] = (df, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.memory_budget:
+            _, (_, evicted_size) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_size
+
+    # Caller must hold the lock
+    def drop_file(self, result_id):
+        path, size = self.files.pop(result_id, (None, 0))
+        if path is not None:
+            self.disk_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # Function to read one page of a stored result; returns None if the result was evicted
+    def get_page(self, handle, page, page_rows=RESULT_PAGE_ROWS):
+        start = page * page_rows
+        stop = min(start + page_rows, handle["rows"])
+        result_id = handle["result_id"]
+        with self.lock:
+            if result_id in self.memory:
+                self.memory.move_to_end(result_id)
+                return self.memory[result_id][0].iloc[start:stop]
+            path = self.files.get(result_id, (None, 0))[0]
+        if path is None:
+            return None
+        page_df = read_rows(path, start, stop)
+        if page_df is not None:
+            page_df.index = pd.RangeIndex(start, start + len(page_df))
+        return page_df
+
+    def get_stats(self):
+        with self.lock:
+            return {"memory_results": len(self.memory), "memory_bytes": self.memory_bytes,
+                    "disk_results": len(self.files), "disk_bytes": self.disk_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.files.clear()
+            self.memory_bytes = 0
+            self.disk_bytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Function to read rows [start, stop) of a Parquet file, touching only the row groups that hold them
+def read_rows(path, start, stop):
+    import pyarrow.parquet as pq
+    try:
+        parquet_file = pq.ParquetFile(path)
+    except OSError:
+        return None
+    groups = []
+    offset = 0
+    first_row = None
+    for index in range(parquet_file.num_row_groups):
+        group_rows = parquet_file.metadata.row_group(index).num_rows
+        if offset + group_rows > start and offset < stop:
+            groups.append(index)
+            first_row = offset if first_row is None else first_row
+        offset += group_rows
+    if not groups:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+    table = parquet_file.read_row_groups(groups)
+    return table.slice(start - first_row, stop - start).to_pandas()
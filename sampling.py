@@ -0,0 +1,188 @@
+import os
+import re
+import time
+from db import get_connection, DATABASE_PATH
+from ingest import quote_identifier
+from query_governor import TABLE_REFERENCE_PATTERN
+
+# Tables with at least this many rows get a uniform random sample of about SAMPLE_TARGET_ROWS rows at ingest,
+# which progressive mode queries first for a quick approximate answer
+SAMPLE_MIN_ROWS = int(os.environ.get("DATADIALOGUE_SAMPLE_MIN_ROWS", "1000000"))
+SAMPLE_TARGET_ROWS = int(os.environ.get("DATADIALOGUE_SAMPLE_TARGET_ROWS", "100000"))
+# Approximate queries that take longer than this are abandoned; the exact result is on its way anyway
+SAMPLE_QUERY_TIMEOUT_SECONDS = float(os.environ.get("DATADIALOGUE_SAMPLE_QUERY_TIMEOUT_SECONDS", "2"))
+# Resolution of the random filter that draws the sample
+SAMPLE_RESOLUTION = 1000000
+
+# Aggregates that grow with the number of rows and are scaled up when run on a sample
+SCALED_AGGREGATE_PATTERN = re.compile(r"\b(COUNT|SUM|TOTAL)\s*\(", re.IGNORECASE)
+DISTINCT_PATTERN = re.compile(r"\s*DISTINCT\b", re.IGNORECASE)
+FILTER_PATTERN = re.compile(r"\s*FILTER\s*\(", re.IGNORECASE)
+WINDOW_PATTERN = re.compile(r"\s*OVER\b", re.IGNORECASE)
+SELECT_PATTERN = re.compile(r"\bSELECT(?:\s+(?:DISTINCT|ALL)\b)?", re.IGNORECASE)
+SELECT_END_PATTERN = re.compile(r"\b(?:FROM|WHERE|GROUP|HAVING|WINDOW|ORDER|LIMIT|UNION|EXCEPT|INTERSECT)\b", re.IGNORECASE)
+# A select item already named, e.g. "COUNT(*) AS n" or "COUNT(*) n"
+ALIAS_PATTERN = re.compile(r"(?:\bAS\s+|\)\s*(?!END\b))(?:\w+|\"(?:[^\"]|\"\")*\"|\[[^\]]*\]|`[^`]*`)\s*$", re.IGNORECASE)
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+
+
+def sample_table_name(table_name):
+    return f"{table_name}_sample"
+
+
+# Function to draw a uniform random sample of a freshly loaded table and register it.
+# Returns the sampling fraction, or None if the table is too small to need a sample.
+def create_sample_table(table_name, row_count, db_path=DATABASE_PATH, min_rows=SAMPLE_MIN_ROWS,
+                        target_rows=SAMPLE_TARGET_ROWS):
+    conn = get_connection(db_path)
+    sample_table = sample_table_name(table_name)
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(sample_table)}")
+        conn.execute("DELETE FROM dataset_samples WHERE table_name = ?", (table_name,))
+    if row_count < min_rows:
+        return None
+    threshold = round(SAMPLE_RESOLUTION * target_rows / row_count)
+    with conn:
+        # Each row is kept independently with the same probability, so every row is equally likely to be in the sample
+        conn.execute(f"CREATE TABLE {quote_identifier(sample_table)} AS SELECT * FROM {quote_identifier(table_name)} "
+                     f"WHERE abs(random() % {SAMPLE_RESOLUTION}) < ?", (threshold,))
+        sample_rows = conn.execute(f"SELECT COUNT(*) FROM {quote_identifier(sample_table)}").fetchone()[0]
+        # The realized fraction is what the sample actually represents, so estimates are scaled by it
+        fraction = sample_rows / row_count
+        conn.execute("INSERT INTO dataset_samples (table_name, sample_table, fraction, row_count, created_at) "
+                     "VALUES (?, ?, ?, ?, ?)", (table_name, sample_table, fraction, sample_rows, time.time()))
+    return fraction
+
+
+# Function to drop the samples of tables that are being removed; runs inside the caller's transaction
+def forget_samples(conn, table_names):
+    for table_name in table_names:
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(sample_table_name(table_name))}")
+        conn.execute("DELETE FROM dataset_samples WHERE table_name = ?", (table_name,))
+
+
+def get_samples(table_names, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    placeholders = ', '.join(['?'] * len(table_names))
+    rows = conn.execute(f"SELECT table_name, sample_table, fraction FROM dataset_samples WHERE table_name IN ({placeholders})",
+                        tuple(table_names)).fetchall()
+    return {table_name: (sample_table, fraction) for table_name, sample_table, fraction in rows}
+
+
+def string_literal_spans(sql):
+    return [match.span() for match in STRING_LITERAL_PATTERN.finditer(sql)]
+
+
+# Function to find the parenthesis closing the one opened just before `start`, skipping string literals
+def closing_parenthesis(sql, start, literals):
+    depth = 1
+    position = start
+    while position < len(sql):
+        literal = next((end for begin, end in literals if begin == position), None)
+        if literal is not None:
+            position = literal
+            continue
+        if sql[position] == "(":
+            depth += 1
+        elif sql[position] == ")":
+            depth -= 1
+            if depth == 0:
+                return position
+        position += 1
+    return None
+
+
+# Function to find the items of the outermost select list as (start, end) spans
+def select_items(sql, literals):
+    items = []
+    depth = 0
+    start = None
+    position = 0
+    while position < len(sql):
+        literal = next((end for begin, end in literals if begin == position), None)
+        if literal is not None:
+            position = literal
+            continue
+        if sql[position] == "(":
+            depth += 1
+        elif sql[position] == ")":
+            depth -= 1
+        elif depth == 0 and start is None and SELECT_PATTERN.match(sql, position):
+            start = SELECT_PATTERN.match(sql, position).end()
+            position = start
+            continue
+        elif depth == 0 and start is not None and sql[position] == ",":
+            items.append((start, position))
+            start = position + 1
+        elif depth == 0 and start is not None and SELECT_END_PATTERN.match(sql, position):
+            break
+        position += 1
+    if start is not None:
+        items.append((start, position))
+    return items
+
+
+# Function to scale COUNT and SUM up by `scale`, so aggregates over a sample estimate the full table.
+# Returns None when the query has an aggregate whose sample value cannot be scaled into an estimate:
+# COUNT(DISTINCT ...) does not grow in proportion to the rows, and window aggregates depend on the frame.
+def scale_aggregates(sql, scale):
+    literals = string_literal_spans(sql)
+    rewrites = []
+    position = 0
+    for match in SCALED_AGGREGATE_PATTERN.finditer(sql):
+        if match.start() < position or any(begin <= match.start() < end for begin, end in literals):
+            continue
+        end = closing_parenthesis(sql, match.end(), literals)
+        if end is None or DISTINCT_PATTERN.match(sql, match.end()):
+            return None
+        # A filtered aggregate counts the matching rows of the sample, so it scales like the plain one
+        aggregate_filter = FILTER_PATTERN.match(sql, end + 1)
+        if aggregate_filter:
+            end = closing_parenthesis(sql, aggregate_filter.end(), literals)
+            if end is None:
+                return None
+        if WINDOW_PATTERN.match(sql, end + 1):
+            return None
+        call = sql[match.start():end + 1]
+        if match.group(1).upper() == "COUNT":
+            rewrites.append((match.start(), end + 1, f"CAST(ROUND({call} * {scale!r}) AS INTEGER)"))
+        else:
+            rewrites.append((match.start(), end + 1, f"({call} * {scale!r})"))
+        position = end + 1
+
+    # Unnamed result columns take the text of their expression; name rewritten ones after the original
+    # text so the estimate is labelled like the exact result
+    aliases = []
+    for start, end in select_items(sql, literals):
+        item = sql[start:end].strip()
+        end = start + len(sql[start:end].rstrip())
+        if any(start <= begin < end for begin, _, _ in rewrites) and not ALIAS_PATTERN.search(item):
+            aliases.append((end, end, ' AS "{}"'.format(item.replace('"', '""'))))
+
+    pieces = []
+    position = 0
+    for begin, end, text in sorted(rewrites + aliases):
+        pieces.append(sql[position:begin] + text)
+        position = end
+    pieces.append(sql[position:])
+    return "".join(pieces)
+
+
+# Function to rewrite a query to read the sample of the one large table it uses, with its row-count aggregates
+# scaled up. Returns (sql, fraction), or (None, None) when no single sampled table is involved.
+def sample_query_for(sql, table_names, db_path=DATABASE_PATH):
+    samples = get_samples(table_names, db_path)
+    references = [match.group(1) for match in TABLE_REFERENCE_PATTERN.finditer(sql)]
+    used = [table_name for table_name in samples if table_name in references]
+    # Joining two samples, or a sample with itself, would keep only fraction² of the matching pairs;
+    # leave such queries to the exact run
+    if len(used) != 1 or references.count(used[0]) > 1:
+        return None, None
+    sample_table, fraction = samples[used[0]]
+    if not fraction:
+        return None, None
+    sample_sql = scale_aggregates(re.sub(rf"\b{re.escape(used[0])}\b", sample_table, sql), 1 / fraction)
+    if sample_sql is None:
+        return None, None
+    return sample_sql, fraction
+
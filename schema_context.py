@@ -0,0 +1,143 @@
+import re
+import threading
+import pandas as pd
+from collections import OrderedDict
+from db import get_connection, DATABASE_PATH
+from ingest import quote_identifier
+from datasets import get_dataset_version
+from sql_cache import schema_fingerprint
+from data_profile import load_profile
+from index_advisor import is_key_column
+
+# Tables at most this wide always go into the prompt in full
+PRUNE_MIN_COLUMNS = 40
+# Upper bound on columns sent for a pruned table, best lexical matches first
+PRUNE_MAX_COLUMNS = 60
+# Example values shown per text column from its ingest-time profile
+PROFILE_EXAMPLE_VALUES = 5
+# Number of precomputed schema contexts kept per process
+SCHEMA_CONTEXT_CACHE_SIZE = 64
+
+# Words that carry no signal about which columns a question refers to
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "each", "for", "from", "give", "has", "have", "how",
+    "i", "in", "is", "it", "list", "many", "me", "much", "of", "on", "or", "per", "show", "than", "that", "the",
+    "their", "there", "this", "to", "top", "was", "were", "what", "when", "where", "which", "who", "with",
+}
+
+_contexts = OrderedDict()
+_contexts_lock = threading.Lock()
+
+
+def load_schema(tables, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    schemas = []
+    for table_name in tables:
+        schema_df = pd.read_sql(f"PRAGMA table_info({quote_identifier(table_name)})", con=conn)
+        schema_df.insert(0, 'table', table_name)
+        schemas.append(schema_df)
+    if not schemas:
+        return pd.DataFrame(columns=['table', 'cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'])
+    return pd.concat(schemas, ignore_index=True)
+
+
+# Function to split text or an identifier like "OrderDate_id" into lowercase word stems
+def tokenize(text):
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    words = re.findall(r"[a-z]+|\d+", text.lower())
+    return {stem(word) for word in words if word not in STOP_WORDS}
+
+
+def stem(word):
+    for suffix in ("ies", "es", "s"):
+        if word.endswith(suffix) and len(word) > len(suffix) + 2:
+            return word[:-len(suffix)] + ("y" if suffix == "ies" else "")
+    return word
+
+
+def format_value(value):
+    return f"{value:.6g}" if isinstance(value, float) else str(value)
+
+
+# Function to summarize a column's ingest-time profile so the model sees real value formats
+def describe_column(profile):
+    if profile is None:
+        return ""
+    hints = []
+    if profile["col_type"] in ("INTEGER", "REAL", "DATE", "TIMESTAMP") and profile["min_value"] is not None:
+        hints.append(f"{format_value(profile['min_value'])} to {format_value(profile['max_value'])}")
+    elif profile["top_values"]:
+        examples = ", ".join(repr(str(value)[:40]) for value, _ in profile["top_values"][:PROFILE_EXAMPLE_VALUES])
+        if profile["distinct_estimate"] <= PROFILE_EXAMPLE_VALUES:
+            hints.append(f"values: {examples}")
+        else:
+            hints.append(f"~{profile['distinct_estimate']:,} distinct, e.g. {examples}")
+    if profile["null_ratio"] > 0:
+        hints.append(f"{profile['null_ratio']:.0%} null")
+    return "; " + "; ".join(hints) if hints else ""
+
+
+def format_table(table_name, columns, profiles=None):
+    profiles = profiles or {}
+    return f"Table '{table_name}':\n" + "\n".join(
+        f"- {name} ({col_type or 'TEXT'}{describe_column(profiles.get(name))})" for name, col_type in columns)
+
+
+# Function to build the schema part of the SQL prompt once per schema version
+def build_schema_context(tables, db_path=DATABASE_PATH):
+    schema_df = load_schema(tables, db_path)
+    profile_df = load_profile(tables, db_path)
+    context = {"schema_df": schema_df, "profile_df": profile_df, "schema_hash": schema_fingerprint(schema_df), "tables": []}
+    for table_name, table_df in schema_df.groupby('table', sort=False):
+        columns = list(table_df[['name', 'type']].itertuples(index=False, name=None))
+        profiles = {p["column_name"]: p for p in profile_df[profile_df["table_name"] == table_name].to_dict("records")}
+        context["tables"].append({
+            "table": table_name,
+            "columns": columns,
+            "profiles": profiles,
+            "tokens": [tokenize(name) for name, _ in columns],
+            "full_text": format_table(table_name, columns, profiles),
+        })
+    context["full_text"] = "\n\n".join(table["full_text"] for table in context["tables"])
+    return context
+
+
+# Function to get the cached schema context for a set of tables; a reload changes the
+# dataset version, so stale contexts are never reused
+def get_schema_context(tables, db_path=DATABASE_PATH):
+    key = (db_path, get_dataset_version(tables, db_path) or ",".join(tables))
+    with _contexts_lock:
+        if key in _contexts:
+            _contexts.move_to_end(key)
+            return _contexts[key]
+    context = build_schema_context(tables, db_path)
+    with _contexts_lock:
+        _contexts[key] = context
+        while len(_contexts) > SCHEMA_CONTEXT_CACHE_SIZE:
+            _contexts.popitem(last=False)
+    return context
+
+
+# Function to render the schema for a question, sending only the columns of wide tables
+# that the question likely refers to. Falls back to the full schema when nothing matches.
+def schema_prompt_for_question(context, question):
+    question_tokens = tokenize(question)
+    sections = []
+    for table in context["tables"]:
+        if len(table["columns"]) <= PRUNE_MIN_COLUMNS:
+            sections.append(table["full_text"])
+            continue
+        scored = []
+        for index, tokens in enumerate(table["tokens"]):
+            score = len(tokens & question_tokens)
+            if score:
+                scored.append((-score, index))
+        if not scored:
+            sections.append(table["full_text"])
+            continue
+        relevant = {index for _, index in sorted(scored)[:PRUNE_MAX_COLUMNS]}
+        relevant.update(index for index, (name, _) in enumerate(table["columns"]) if is_key_column(name))
+        columns = [table["columns"][index] for index in sorted(relevant)]
+        omitted = len(table["columns"]) - len(columns)
+        sections.append(format_table(table["table"], columns, table["profiles"]) + f"\n({omitted} other columns not relevant to the question are omitted)")
+    return "\n\n".join(sections)
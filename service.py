@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import http.server
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from db import migrate_database
+from datasets import list_datasets, get_dataset_tables, touch_dataset
+from pipeline import generate_sql_query, run_query, format_answer_in_text_form
+from metrics import trace_turn, span, render_prometheus
+
+# Requests handled at once; most of a request's time is spent waiting on the LLM
+SERVICE_WORKERS = int(os.environ.get("DATADIALOGUE_SERVICE_WORKERS", "32"))
+# Requests allowed to wait for a worker; beyond this, clients get 503 and should retry
+SERVICE_QUEUE_SIZE = int(os.environ.get("DATADIALOGUE_SERVICE_QUEUE_SIZE", "64"))
+# Threads running SQLite queries; SQLite releases the GIL while it works, so this scales with cores
+SQL_WORKERS = int(os.environ.get("DATADIALOGUE_SQL_WORKERS", str(os.cpu_count() or 4)))
+# Result rows returned in a response unless the request asks for fewer
+RESPONSE_MAX_ROWS = 1000
+MAX_REQUEST_BYTES = 1 << 20
+REJECT_TIMEOUT_SECONDS = 1
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Function to answer one question against a dataset: generate SQL, run it on the SQL pool and summarize.
+# The LLM calls share the process-wide limiter in llm.py.
+def answer_request(request, sql_pool):
+    question = request.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise ServiceError(400, "'question' must be a non-empty string")
+    fingerprint = request.get("dataset")
+    if not isinstance(fingerprint, str):
+        raise ServiceError(400, "'dataset' must be a dataset fingerprint; see GET /datasets")
+    tables = get_dataset_tables(fingerprint)
+    if tables is None:
+        raise ServiceError(404, f"Dataset {fingerprint} is not loaded")
+    max_rows = request.get("max_rows", RESPONSE_MAX_ROWS)
+    if isinstance(max_rows, bool) or not isinstance(max_rows, int) or max_rows < 0:
+        raise ServiceError(400, "'max_rows' must be a non-negative integer")
+    touch_dataset(tables)
+
+    timings = {}
+    started = time.perf_counter()
+    sql_query = generate_sql_query(question, tables)
+    timings["sql"] = time.perf_counter() - started
+
+    stage_started = time.perf_counter()
+    try:
+        result = sql_pool.submit(run_query, sql_query, tables).result()
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        raise ServiceError(422, f"Error executing query: {e}") from e
+    timings["query"] = time.perf_counter() - stage_started
+
+    answer = None
+    if request.get("summarize", True):
+        stage_started = time.perf_counter()
+        answer = format_answer_in_text_form(question, result, sql_query)
+        timings["summary"] = time.perf_counter() - stage_started
+    timings["total"] = time.perf_counter() - started
+
+    rows = json.loads(result.head(max_rows).to_json(orient="split", index=False, date_format="iso"))
+    return {
+        "question": question,
+        "dataset": fingerprint,
+        "sql": sql_query,
+        "columns": rows["columns"],
+        "rows": rows["data"],
+        "row_count": len(result),
+        "truncated": bool(result.attrs.get("truncated")) or len(result) > max_rows,
+        "warnings": result.attrs.get("warnings", []),
+        "answer": answer,
+        "timings": timings,
+    }
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "DataDialogue"
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", **self.server.get_load()})
+        elif self.path == "/datasets":
+            self.send_json(200, {"datasets": list_datasets()})
+        elif self.path == "/metrics":
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/ask":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_REQUEST_BYTES:
+                raise ServiceError(413, "Request body is too large")
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as e:
+                raise ServiceError(400, f"Request body is not valid JSON: {e}") from e
+            if not isinstance(request, dict):
+                raise ServiceError(400, "Request body must be a JSON object")
+            with trace_turn(), span("turn"):
+                response = answer_request(request, self.server.sql_pool)
+            self.send_json(200, response)
+        except ServiceError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": f"An error occurred: {e}"})
+
+
+# Handler that answers every request with 503; used on the accepting thread when the queue is full
+class BusyHandler(ServiceHandler):
+    def reject(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= MAX_REQUEST_BYTES:
+            # Read the body so the client sees the response rather than a reset connection
+            self.rfile.read(length)
+        self.send_response(503)
+        self.send_header("Retry-After", "1")
+        body = json.dumps({"error": "Server is busy, retry later"}).encode()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = reject
+
+
+# HTTP server that hands connections to a fixed worker pool instead of a thread per connection.
+# At most `workers` requests run and `queue_size` wait; further connections get 503 right away.
+class QueryServer(http.server.HTTPServer):
+    def __init__(self, address, workers=SERVICE_WORKERS, queue_size=SERVICE_QUEUE_SIZE, sql_workers=SQL_WORKERS):
+        super().__init__(address, ServiceHandler)
+        self.workers = workers
+        self.request_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="service")
+        self.sql_pool = ThreadPoolExecutor(max_workers=sql_workers, thread_name_prefix="service-sql")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.capacity = workers + queue_size
+        self.in_flight = 0
+        self.load_lock = threading.Lock()
+
+    def get_load(self):
+        with self.load_lock:
+            in_flight = self.in_flight
+        return {"active": min(in_flight, self.workers), "queued": max(in_flight - self.workers, 0), "capacity": self.capacity}
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.reject(request, client_address)
+            return
+        with self.load_lock:
+            self.in_flight += 1
+        self.request_pool.submit(self.process_request_in_pool, request, client_address)
+
+    def process_request_in_pool(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.load_lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def reject(self, request, client_address):
+        # A short timeout keeps a slow client from stalling the accepting thread
+        request.settimeout(REJECT_TIMEOUT_SECONDS)
+        try:
+            BusyHandler(request, client_address, self)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.request_pool.shutdown(wait=True)
+        self.sql_pool.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless DataDialogue query service (HTTP/JSON)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS, help="requests handled at once")
+    parser.add_argument("--queue-size", type=int, default=SERVICE_QUEUE_SIZE, help="requests allowed to wait before 503")
+    parser.add_argument("--sql-workers", type=int, default=SQL_WORKERS, help="threads running SQLite queries")
+    args = parser.parse_args()
+
+    migrate_database()
+    server = QueryServer((args.host, args.port), args.workers, args.queue_size, args.sql_workers)
+    print(f"Serving on http://{args.host}:{args.port} (POST /ask, GET /datasets, GET /health, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import os
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from db import get_connection, DATABASE_PATH
+
+# Generated SQL is reused for this long and the cache keeps at most this many entries
+SQL_CACHE_TTL_SECONDS = int(os.environ.get("DATADIALOGUE_SQL_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+SQL_CACHE_MAX_ENTRIES = int(os.environ.get("DATADIALOGUE_SQL_CACHE_MAX_ENTRIES", "5000"))
+
+# Politeness words and articles that do not change what a question asks for
+FILLER_WORDS = {"a", "an", "the", "please", "kindly", "can", "could", "would", "you", "me", "tell", "show", "give"}
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+# Function to reduce a question to a canonical form so trivial rewordings share a cache entry
+def normalize_question(question):
+    text = unicodedata.normalize("NFKC", str(question)).lower()
+    text = re.sub(r"[^\w\s.%<>=-]", " ", text)
+    text = re.sub(r"(?<!\d)\.|\.(?!\d)", " ", text)
+    words = [word for word in text.split() if word not in FILLER_WORDS]
+    return " ".join(words)
+
+
+# Function to hash the table names, column names and types a query is generated against
+def schema_fingerprint(schema_df):
+    digest = hashlib.sha256()
+    for table, name, col_type in schema_df[['table', 'name', 'type']].itertuples(index=False, name=None):
+        digest.update(f"{table}\x1f{name}\x1f{col_type}\x1e".encode())
+    return digest.hexdigest()
+
+
+def cache_key(question, schema_hash):
+    return hashlib.sha256(f"{schema_hash}\x1e{normalize_question(question)}".encode()).hexdigest()
+
+
+def record(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+# Function to get the cached SQL for a question against a schema, or None on a miss
+def lookup_sql(question, schema_hash, db_path=DATABASE_PATH, ttl_seconds=SQL_CACHE_TTL_SECONDS):
+    conn = get_connection(db_path)
+    key = cache_key(question, schema_hash)
+    row = conn.execute("SELECT sql, created_at FROM sql_cache WHERE cache_key = ?", (key,)).fetchone()
+    now = time.time()
+    if row is None:
+        record("misses")
+        return None
+    with conn:
+        if now - row[1] > ttl_seconds:
+            conn.execute("DELETE FROM sql_cache WHERE cache_key = ?", (key,))
+            record("misses")
+            return None
+        conn.execute("UPDATE sql_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?", (now, key))
+    record("hits")
+    return row[0]
+
+
+# Function to cache generated SQL, trimming least recently used entries beyond the size bound
+def store_sql(question, schema_hash, tables, sql, db_path=DATABASE_PATH, max_entries=SQL_CACHE_MAX_ENTRIES):
+    conn = get_connection(db_path)
+    now = time.time()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO sql_cache (cache_key, schema_hash, tables, question, sql, created_at, last_used_at, hits) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                     (cache_key(question, schema_hash), schema_hash, ",".join(tables), normalize_question(question), sql, now, now))
+        conn.execute("DELETE FROM sql_cache WHERE cache_key IN "
+                     "(SELECT cache_key FROM sql_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)", (max_entries,))
+
+
+# Function to drop cached SQL that failed to run, so the next ask generates it afresh instead of replaying it
+def forget_sql(sql, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("DELETE FROM sql_cache WHERE sql = ?", (sql,))
+
+
+# Function to drop cached SQL generated against tables that were reloaded or removed
+def invalidate_sql_cache(tables, db_path=DATABASE_PATH):
+    conn = get_connection(db_path)
+    with conn:
+        for table_name in tables:
+            conn.execute("DELETE FROM sql_cache WHERE instr(',' || tables || ',', ?) > 0", (f",{table_name},",))
+
+
+def get_sql_cache_stats():
+    with _stats_lock:
+        return dict(_stats)
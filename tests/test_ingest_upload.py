@@ -0,0 +1,44 @@
+import io
+from openpyxl import Workbook
+from db import migrate_database
+from datasets import ingest_upload, get_dataset_tables
+from ingest import read_file_tables
+
+
+def workbook_upload(sheets, name="book.xlsx"):
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for title, rows in sheets.items():
+        worksheet = workbook.create_sheet(title)
+        for row in rows:
+            worksheet.append(row)
+    file = io.BytesIO()
+    workbook.save(file)
+    file.seek(0)
+    file.name = name
+    return file
+
+
+def test_header_only_sheet_does_not_fail_the_workbook(tmp_path):
+    db_path = str(tmp_path / "data.db")
+    migrate_database(db_path, str(tmp_path / "chat.db"))
+    upload = workbook_upload({
+        "Sales": [("region", "amount"), ("North", 10), ("South", 20)],
+        "Notes": [("Figures are in thousands",)],
+        "Blank": [],
+    })
+    tables = ingest_upload(upload, "f" * 16, db_path)
+    assert [(table["sheet"], table["rows"]) for table in tables] == [("Sales", 2), ("Notes", 0)]
+    assert list(tables[1]["columns"]) == ["Figures are in thousands"]
+    assert len(get_dataset_tables("f" * 16, db_path)) == 2
+
+
+def test_header_only_sheet_reads_like_header_only_csv():
+    csv_upload = io.BytesIO(b"region,amount\n")
+    csv_upload.name = "sales.csv"
+    (_, csv_chunks), = read_file_tables(csv_upload)
+    (_, sheet_chunks), = read_file_tables(workbook_upload({"Sales": [("region", "amount")]}))
+    csv_frames, sheet_frames = list(csv_chunks), list(sheet_chunks)
+    assert len(csv_frames) == len(sheet_frames) == 1
+    assert list(csv_frames[0].columns) == list(sheet_frames[0].columns) == ["region", "amount"]
+    assert sheet_frames[0].empty
@@ -0,0 +1,29 @@
+import pandas as pd
+from result_encoding import encode_result_for_prompt, encode_aggregates, truncate_cells
+
+
+# A self-join such as SELECT a.id, b.id ... returns two columns with the same name
+def duplicate_column_result(rows):
+    df = pd.DataFrame({"id": range(rows), "other_id": range(rows), "name": [f"row {index}" for index in range(rows)]})
+    df.columns = ["id", "id", "name"]
+    return df
+
+
+def test_truncate_cells_keeps_duplicate_columns():
+    df = duplicate_column_result(3)
+    df.iloc[0, 2] = "x" * 100
+    truncated = truncate_cells(df, max_chars=10)
+    assert list(truncated.columns) == ["id", "id", "name"]
+    assert truncated.iloc[0, 2] == "x" * 9 + "…"
+    assert truncated.iloc[:, 1].tolist() == [0, 1, 2]
+
+
+def test_encode_duplicate_columns_as_rows():
+    text = encode_result_for_prompt(duplicate_column_result(3))
+    assert text.splitlines()[1] == "id,id,name"
+
+
+def test_encode_duplicate_columns_as_aggregates():
+    text = encode_aggregates(duplicate_column_result(50), max_chars=100_000)
+    assert "name: 50 distinct, 0 nulls" in text
+    assert text.count("\nid,0,0,49,") == 2
@@ -0,0 +1,12 @@
+import pytest
+import service
+from service import answer_request, ServiceError
+
+
+@pytest.mark.parametrize("max_rows", [True, False, -1, 1.5, "10"])
+def test_invalid_max_rows_is_a_bad_request(monkeypatch, max_rows):
+    monkeypatch.setattr(service, "get_dataset_tables", lambda fingerprint: ["dataset_table"])
+    request = {"question": "How many rows are there?", "dataset": "f" * 16, "max_rows": max_rows}
+    with pytest.raises(ServiceError) as error:
+        answer_request(request, sql_pool=None)
+    assert error.value.status == 400
@@ -3,16 +3,8 @@ import json
 import pandas as pd
 import streamlit as st
 from typing import Iterator
-from langchain_anthropic import ChatAnthropic
 import time
 
-model   =   ChatAnthropic(
-                model="claude-3-5-sonnet-20240620",
-                    temperature=0,
-             max_tokens= 8192, top_p= 0
-            )
-    
-
 def styled_markdown(text, font_size="16px", font_family="Arial, sans-serif", color="#4a4a4a"):
     styled_text = f"""
     <p style="font-size: {font_size}; font-family: {font_family}; color: {color}; font-weight: bold;">